@@ -1,7 +1,7 @@
 import os # Import os
 from flask import Flask
 from config import Config # Import Config class
-from extensions import db, login_manager, migrate
+from extensions import db, login_manager, migrate, broker, assets, compress
 from datetime import datetime
 from commands import register_commands
 
@@ -28,16 +28,19 @@ def create_app():
     db.init_app(app)
     login_manager.init_app(app)
     migrate.init_app(app, db)
+    broker.init_app(app)
+    assets.init_app(app) # Fingerprinted, precompressed static files (flask build-assets)
+    compress.init_app(app) # gzip/brotli for HTML and JSON responses
     login_manager.login_view = 'main.login'
 
     # Set up user_loader
-    from models import User
+    from cache import user_cache
 
     @login_manager.user_loader
     def load_user(user_id):
         try:
             user_id_int = int(user_id)
-            return User.query.get(user_id_int)
+            return user_cache.get(user_id_int) # Per-process cache; see cache.UserCache
         except (ValueError, TypeError):
             return None
         except Exception as e:
@@ -56,6 +59,10 @@ def create_app():
     from routes import main_bp
     app.register_blueprint(main_bp)
 
+    # Release expired cart reservations in the background
+    from reservations import reservation_sweeper
+    reservation_sweeper.init_app(app)
+
     # Register CLI commands
     register_commands(app)
 
@@ -0,0 +1,165 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import current_app, request
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only gzip siblings are written
+    brotli = None
+
+MANIFEST_NAME = 'manifest.json'
+HASH_LENGTH = 12
+# Build outputs, recognised so a rebuild doesn't fingerprint them again
+FINGERPRINTED_RE = re.compile(r'\.[0-9a-f]{%d}(\.[^./]+)?$' % HASH_LENGTH)
+COMPRESSED_SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+# Text formats worth compressing; images and fonts are compressed already
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.mjs', '.json', '.svg', '.txt', '.html', '.map', '.xml', '.ico'}
+CSS_URL_RE = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def build_assets(static_folder, static_url_path='/static', clean=False):
+    """
+    Fingerprints every file in the static folder (styles.css -> styles.<hash>.css), writes
+    gzip and brotli siblings of the text files when that makes them smaller, and records the
+    results in manifest.json. Stylesheets are built last, with their url(...) references
+    rewritten to the fingerprinted names. Returns the manifest entries.
+    """
+    sources = []
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            relative = os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+            if relative == MANIFEST_NAME or name.endswith(('.gz', '.br')) or FINGERPRINTED_RE.search(name):
+                continue
+            sources.append(relative)
+    sources.sort(key=lambda relative: (relative.endswith('.css'), relative))
+
+    entries = {}
+    for relative in sources:
+        with open(os.path.join(static_folder, relative), 'rb') as f:
+            data = f.read()
+        if relative.endswith('.css'):
+            data = _rewrite_css_urls(data, entries, static_url_path)
+        digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        stem, extension = os.path.splitext(relative)
+        hashed = f"{stem}.{digest}{extension}"
+        _write(static_folder, hashed, data)
+
+        encodings = []
+        if extension.lower() in COMPRESSIBLE_EXTENSIONS:
+            compressed = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressed['br'] = brotli.compress(data, quality=11)
+            for encoding, body in compressed.items():
+                if len(body) < len(data):
+                    _write(static_folder, hashed + COMPRESSED_SUFFIXES[encoding], body)
+                    encodings.append(encoding)
+        entries[relative] = {'path': hashed, 'encodings': encodings}
+
+    _write(static_folder, MANIFEST_NAME, json.dumps({'files': entries}, indent=2, sort_keys=True).encode())
+    if clean:
+        _remove_stale_outputs(static_folder, entries)
+    return entries
+
+
+def _rewrite_css_urls(data, entries, static_url_path):
+    prefix = static_url_path.rstrip('/') + '/'
+
+    def replace(match):
+        quote, url = match.group(1), match.group(2)
+        if url.startswith(prefix) and url[len(prefix):] in entries:
+            url = prefix + entries[url[len(prefix):]]['path']
+        return f"url({quote}{url}{quote})"
+
+    return CSS_URL_RE.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+def _write(static_folder, relative, data):
+    path = os.path.join(static_folder, relative)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def _remove_stale_outputs(static_folder, entries):
+    current = {entry['path'] for entry in entries.values()}
+    current |= {entry['path'] + COMPRESSED_SUFFIXES[encoding]
+                for entry in entries.values() for encoding in entry['encodings']}
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            relative = os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+            base = relative[:-3] if relative.endswith(('.gz', '.br')) else relative
+            if FINGERPRINTED_RE.search(os.path.basename(base)) and relative not in current:
+                os.remove(os.path.join(root, name))
+
+
+class StaticAssets:
+    """
+    Flask extension serving the output of build_assets (flask build-assets):
+    url_for('static', filename='styles.css') resolves to the fingerprinted name, and the
+    static route sends fingerprinted files as immutable, picking the precompressed sibling
+    the client accepts. Without a manifest, static files behave as before.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.load_manifest(app)
+        app.url_defaults(self._hashed_static_filename)
+        if 'static' in app.view_functions:
+            app.view_functions['static'] = self.send_static_file
+
+    def load_manifest(self, app):
+        files = {}
+        path = os.path.join(app.static_folder, MANIFEST_NAME) if app.static_folder else None
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    files = json.load(f).get('files', {})
+            except (OSError, ValueError) as e:
+                app.logger.error(f"Error loading static asset manifest {path}: {e}")
+        app.extensions['static_assets'] = {
+            'files': files,
+            'hashed': {entry['path']: entry for entry in files.values()},  # fingerprinted name -> entry
+        }
+
+    @staticmethod
+    def _hashed_static_filename(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            entry = current_app.extensions['static_assets']['files'].get(values['filename'])
+            if entry is not None:
+                values['filename'] = entry['path']
+
+    def send_static_file(self, filename):
+        entry = current_app.extensions['static_assets']['hashed'].get(filename)
+        if entry is None:
+            return current_app.send_static_file(filename)  # Not built: Flask's default handling
+
+        path = safe_join(current_app.static_folder, filename)
+        # Ties go to the first match: prefer brotli, then gzip, then the plain file
+        available = [encoding for encoding in ('br', 'gzip') if encoding in entry['encodings']]
+        encoding = request.accept_encodings.best_match(available + ['identity'])
+        if encoding in COMPRESSED_SUFFIXES:
+            path += COMPRESSED_SUFFIXES[encoding]
+        response = send_file(path, request.environ, mimetype=mimetypes.guess_type(filename)[0],
+                             etag=f"{filename}-{encoding or 'identity'}", conditional=True,
+                             response_class=current_app.response_class)
+        if encoding in COMPRESSED_SUFFIXES:
+            response.headers['Content-Encoding'] = encoding
+        if entry['encodings']:
+            response.vary.add('Accept-Encoding')
+        # The name changes whenever the content does, so it can be cached for good
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get('STATIC_CACHE_MAX_AGE', 31536000)
+        response.cache_control.immutable = True
+        return response
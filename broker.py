@@ -0,0 +1,142 @@
+import json
+import queue
+import threading
+from collections import defaultdict
+
+from flask import current_app
+
+
+class LocalBackend:
+    """
+    In-process pub/sub. Each subscription gets its own queue, so a slow reader never
+    blocks publishers. Only reaches subscribers in the same process: use the Redis
+    backend when running several worker processes.
+    """
+
+    def __init__(self, max_queue_size=1000):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)  # channel -> set of subscription queues
+        self._max_queue_size = max_queue_size
+
+    def publish(self, channel, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((channel, data))
+            except queue.Full:
+                pass  # Reader has stalled; it catches up from the database when it reconnects
+
+    def subscribe(self, channels):
+        subscription = LocalSubscription(self, channels, queue.Queue(self._max_queue_size))
+        with self._lock:
+            for channel in channels:
+                self._subscribers[channel].add(subscription.queue)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription.queue)
+                    if not subscribers:
+                        del self._subscribers[channel]
+
+
+class LocalSubscription:
+    def __init__(self, backend, channels, event_queue):
+        self.backend = backend
+        self.channels = list(channels)
+        self.queue = event_queue
+
+    def get(self, timeout):
+        """Returns the next (channel, data) pair, or None if nothing arrived within timeout seconds."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.backend._unsubscribe(self)
+
+
+class RedisBackend:
+    """Pub/sub over Redis, shared by every worker process. Requires the optional `redis` package."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("MESSAGE_BROKER_URL points at Redis but the 'redis' package is not installed.") from e
+        self._redis = redis.Redis.from_url(url)
+
+    def publish(self, channel, data):
+        self._redis.publish(channel, json.dumps(data))
+
+    def subscribe(self, channels):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*channels)
+        return RedisSubscription(pubsub)
+
+
+class RedisSubscription:
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def get(self, timeout):
+        message = self.pubsub.get_message(timeout=timeout)
+        if message is None:
+            return None
+        channel = message['channel']
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        return channel, json.loads(message['data'])
+
+    def close(self):
+        self.pubsub.close()
+
+
+def create_backend(url):
+    """Builds a broker backend from a URL: 'memory://' for in-process, 'redis://...' for Redis."""
+    if not url or url.startswith('memory://'):
+        return LocalBackend()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    raise ValueError(f"Unsupported MESSAGE_BROKER_URL: {url}")
+
+
+class MessageBroker:
+    """
+    Flask extension publishing real-time events (new messages) to subscribed streams.
+    The backend is chosen from MESSAGE_BROKER_URL and can be swapped with set_backend,
+    e.g. to use a LocalBackend in tests instead of Redis.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['message_broker'] = create_backend(app.config.get('MESSAGE_BROKER_URL', 'memory://'))
+
+    def set_backend(self, backend, app=None):
+        (app or current_app).extensions['message_broker'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions['message_broker']
+
+    def publish(self, channel, data):
+        self.backend.publish(channel, data)
+
+    def subscribe(self, channels):
+        return self.backend.subscribe(channels)
+
+
+def conversation_channel(conversation_id):
+    return f"conversation:{conversation_id}"
+
+
+def user_channel(user_id):
+    return f"user:{user_id}"
@@ -0,0 +1,340 @@
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app
+from sqlalchemy.orm import make_transient_to_detached
+
+from extensions import db
+from models import MarketPrice, ProductListing, User
+from price_rollups import last_week_prices
+
+
+class CategoryFacetCache:
+    """
+    Per-process cache of the catalog's category facets: (category, active listing count)
+    pairs sorted by category name.
+
+    Listing writes in this process invalidate it immediately; the TTL bounds how
+    long writes made by other worker processes take to show up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._facets = None
+        self._loaded_at = 0.0
+
+    def get(self):
+        ttl = current_app.config.get('FACET_CACHE_TTL', 60)
+        facets = self._facets
+        if facets is not None and time.monotonic() - self._loaded_at < ttl:
+            return facets
+        with self._lock:
+            # Another thread may have reloaded while we waited for the lock
+            if self._facets is None or time.monotonic() - self._loaded_at >= ttl:
+                self._facets = self._load()
+                self._loaded_at = time.monotonic()
+            return self._facets
+
+    def invalidate(self):
+        with self._lock:
+            self._facets = None
+
+    @staticmethod
+    def _load():
+        rows = db.session.query(ProductListing.category, db.func.count(ProductListing.id)) \
+            .filter(ProductListing.status == 'active', ProductListing.category.isnot(None)) \
+            .group_by(ProductListing.category) \
+            .order_by(ProductListing.category).all()
+        return [(category, count) for category, count in rows]
+
+
+category_facets = CategoryFacetCache()
+
+
+class FileStatCache:
+    """
+    Per-process LRU cache of file metadata for uploaded files: absolute path -> (size, mtime),
+    or None if the file doesn't exist. Lets image requests (and 304 answers in particular)
+    skip the filesystem. Entries expire after UPLOAD_STAT_CACHE_TTL seconds, so files
+    written or removed by other processes (e.g. the image worker) show up.
+    """
+
+    def __init__(self, max_entries=10000):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # path -> ((size, mtime) or None, loaded_at)
+        self._max_entries = max_entries
+
+    def get(self, path):
+        ttl = current_app.config.get('UPLOAD_STAT_CACHE_TTL', 60)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and now - entry[1] < ttl:
+                self._entries.move_to_end(path)
+                return entry[0]
+        try:
+            result = os.stat(path)
+            info = (result.st_size, result.st_mtime) if stat.S_ISREG(result.st_mode) else None
+        except OSError:
+            info = None
+        with self._lock:
+            self._entries[path] = (info, now)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return info
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+
+upload_stats = FileStatCache()
+
+
+class LocalVersionStore:
+    """Version counters kept in this process. Fine for a single worker process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def get(self, key):
+        return self._versions.get(key, 0)
+
+    def bump(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+
+class RedisVersionStore:
+    """
+    Version counters in Redis, shared by every worker process, so a write in one process
+    invalidates the caches of all of them. Requires the optional `redis` package.
+    """
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("CACHE_VERSION_URL points at Redis but the 'redis' package is not installed.") from e
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return int(self._redis.get(key) or 0)
+
+    def bump(self, key):
+        return self._redis.incr(key)
+
+
+def create_version_store(url):
+    """Builds a version store from a URL: 'memory://' for in-process, 'redis://...' for Redis."""
+    if not url or url.startswith('memory://'):
+        return LocalVersionStore()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisVersionStore(url)
+    raise ValueError(f"Unsupported CACHE_VERSION_URL: {url}")
+
+
+def version_store():
+    """The app's version store, created from CACHE_VERSION_URL on first use."""
+    extensions = current_app.extensions
+    if 'cache_versions' not in extensions:
+        extensions['cache_versions'] = create_version_store(current_app.config.get('CACHE_VERSION_URL', 'memory://'))
+    return extensions['cache_versions']
+
+
+PriceBoardRow = namedtuple('PriceBoardRow', 'id name category price unit location updated_at last_week_price')
+
+
+class PriceBoardCache:
+    """
+    Per-process cache of the market price board: every MarketPrice as a PriceBoardRow, sorted
+    by (category, name) and with last week's price from the rollups, plus an LRU of rendered
+    table fragments per search term.
+
+    Everything is tagged with a version number from CACHE_VERSION_URL, which price writes
+    bump through invalidate(). With a Redis URL all worker processes share the number, so a
+    write anywhere is seen everywhere on the next request; with 'memory://' other processes
+    pick it up after PRICE_BOARD_CACHE_TTL seconds.
+    """
+
+    VERSION_KEY = 'cache-version:market-prices'
+
+    def __init__(self, max_fragments=256):
+        self._lock = threading.Lock()
+        self._board = None
+        self._version = None
+        self._loaded_at = 0.0
+        self._fragments = OrderedDict()  # normalized search term -> rendered HTML
+        self._max_fragments = max_fragments
+
+    def board(self):
+        """All market prices, sorted by (category, name)."""
+        return self._current()[1]
+
+    def search(self, term):
+        """Board rows whose name or category contains `term` (case-insensitive)."""
+        return self._filter(self.board(), term)
+
+    def fragment(self, term, render):
+        """
+        Rendered HTML for the board filtered by `term`. On a miss, render(rows) produces it
+        and the result is kept until the next price write.
+        """
+        version, board = self._current()
+        key = (term or '').strip().lower()
+        with self._lock:
+            html = self._fragments.get(key) if self._version == version else None
+            if html is not None:
+                self._fragments.move_to_end(key)
+                return html
+        html = render(self._filter(board, key))
+        with self._lock:
+            # Don't store output rendered from a board that was replaced meanwhile
+            if self._version == version:
+                self._fragments[key] = html
+                while len(self._fragments) > current_app.config.get('PRICE_FRAGMENT_CACHE_SIZE', self._max_fragments):
+                    self._fragments.popitem(last=False)
+        return html
+
+    def invalidate(self):
+        """Call after committing a change to market prices."""
+        store = version_store()
+        try:
+            store.bump(self.VERSION_KEY)
+        except Exception as e:
+            print(f"Error bumping market price cache version: {e}")
+        with self._lock:
+            self._board = None
+            self._fragments.clear()
+
+    def _current(self):
+        version = self._shared_version()
+        ttl = current_app.config.get('PRICE_BOARD_CACHE_TTL', 300)
+        with self._lock:
+            if (self._board is None or self._version != version
+                    or time.monotonic() - self._loaded_at >= ttl):
+                # The version was read before loading, so a write during the load is caught next time
+                self._board = self._load()
+                self._version = version
+                self._loaded_at = time.monotonic()
+                self._fragments.clear()
+            return self._version, self._board
+
+    def _shared_version(self):
+        store = version_store()
+        try:
+            return store.get(self.VERSION_KEY)
+        except Exception as e:
+            # Shared store unreachable: keep serving what we have until the TTL runs out
+            print(f"Error reading market price cache version: {e}")
+            return self._version
+
+    @staticmethod
+    def _filter(board, term):
+        term = (term or '').strip().lower()
+        if not term:
+            return board
+        return [row for row in board
+                if term in row.name.lower() or term in (row.category or '').lower()]
+
+    @staticmethod
+    def _load():
+        rows = db.session.query(MarketPrice.id, MarketPrice.name, MarketPrice.category, MarketPrice.price,
+                                MarketPrice.unit, MarketPrice.location, MarketPrice.updated_at) \
+            .order_by(MarketPrice.category, MarketPrice.name).all()
+        last_week = last_week_prices()
+        return [PriceBoardRow(*row, last_week.get(row.id)) for row in rows]
+
+
+price_board = PriceBoardCache()
+
+
+class UserCache:
+    """
+    Per-process LRU of the column values of recently active users, keyed by id, so Flask-Login's
+    user loader doesn't query the users table on every request.
+
+    Each entry carries the user's version number from CACHE_VERSION_URL, which edit_user,
+    delete_user and register bump through invalidate(user_id). With a Redis URL every worker
+    process sees the change on its next request; with 'memory://' other processes pick it up
+    after USER_CACHE_TTL seconds.
+
+    Cached values are turned back into a User attached to the current session without a
+    query, so relationships still load and changes to current_user are saved as usual.
+    unread_message_count changes with every message and is never cached: it is loaded from
+    the database when accessed.
+    """
+
+    UNCACHED_COLUMNS = ('unread_message_count',)
+
+    def __init__(self, max_entries=1000):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (column values, version, loaded_at)
+        self._max_entries = max_entries
+
+    def get(self, user_id):
+        """The User with this id (attached to the current session), or None if there is none."""
+        try:
+            version = version_store().get(self._version_key(user_id))
+        except Exception as e:
+            # Shared store unreachable: can't tell if an entry is current, so go to the database
+            print(f"Error reading user cache version for user {user_id}: {e}")
+            return db.session.get(User, user_id)
+        ttl = current_app.config.get('USER_CACHE_TTL', 300)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] == version and time.monotonic() - entry[2] < ttl:
+                self._entries.move_to_end(user_id)
+                values = entry[0]
+            else:
+                values = None
+        if values is not None:
+            return self._attach(values)
+
+        user = db.session.get(User, user_id)
+        if user is not None:
+            values = {column.key: getattr(user, column.key) for column in User.__table__.columns
+                      if column.key not in self.UNCACHED_COLUMNS}
+            with self._lock:
+                self._entries[user_id] = (values, version, time.monotonic())
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > current_app.config.get('USER_CACHE_SIZE', self._max_entries):
+                    self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        """Call after committing a change to (or the deletion of) a user."""
+        try:
+            version_store().bump(self._version_key(user_id))
+        except Exception as e:
+            print(f"Error bumping user cache version for user {user_id}: {e}")
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Forgets every user cached in this process (other processes keep theirs)."""
+        with self._lock:
+            self._entries.clear()
+
+    @staticmethod
+    def _version_key(user_id):
+        return f"cache-version:user:{user_id}"
+
+    @staticmethod
+    def _attach(values):
+        user = User(**values)
+        make_transient_to_detached(user)
+        # load=False: adopt the cached state as the persistent row, without a SELECT
+        return db.session.merge(user, load=False)
+
+
+user_cache = UserCache()
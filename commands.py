@@ -1,6 +1,6 @@
 import click
 from flask.cli import with_appcontext
-from models import db, User # Import necessary models
+from models import db, User, ProductListing, Conversation, Message # Import necessary models
 
 # You might need to import your Flask app instance if db requires it,
 # but usually 'with_appcontext' handles this.
@@ -38,7 +38,242 @@ def create_admin_command(username, email, password):
         db.session.rollback()
         click.echo(f"Error creating admin user: {str(e)}")
 
+
+@click.command('reindex-search')
+@with_appcontext
+def reindex_search_command():
+    """Rebuilds the product search index (search_vector column on PostgreSQL)."""
+    from search import build_search_vector, search_index, use_native_search
+
+    if not use_native_search():
+        # The in-process index lives in each web worker and is rebuilt there on demand
+        search_index.rebuild()
+        click.echo("Search backend is the in-process index; workers rebuild it automatically.")
+        return
+
+    try:
+        updated = ProductListing.query.update(
+            {ProductListing.search_vector: build_search_vector(
+                ProductListing.name, ProductListing.category, ProductListing.description)},
+            synchronize_session=False
+        )
+        db.session.commit()
+        click.echo(f"Reindexed {updated} product listings.")
+    except Exception as e:
+        db.session.rollback()
+        click.echo(f"Error reindexing product listings: {str(e)}")
+
+@click.command('recount-unread')
+@with_appcontext
+def recount_unread_command():
+    """Recomputes the denormalized unread counters and last messages from the messages table."""
+    def unread_for(recipient_column, *conditions):
+        return db.select(db.func.count(Message.id)).where(
+            Message.recipient_id == recipient_column,
+            Message.is_read.is_(False),
+            *conditions
+        ).scalar_subquery()
+
+    try:
+        user_result = db.session.execute(
+            db.update(User).values(unread_message_count=unread_for(User.id))
+            .execution_options(synchronize_session=False)
+        )
+        in_conversation = Message.conversation_id == Conversation.id
+        conversation_result = db.session.execute(
+            db.update(Conversation).values(
+                unread_count_buyer=unread_for(Conversation.buyer_id, in_conversation),
+                unread_count_farmer=unread_for(Conversation.farmer_id, in_conversation),
+                last_message_id=db.select(db.func.max(Message.id)).where(in_conversation).scalar_subquery()
+            ).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        click.echo(f"Recounted unread messages for {user_result.rowcount} users "
+                   f"and {conversation_result.rowcount} conversations.")
+    except Exception as e:
+        db.session.rollback()
+        click.echo(f"Error recounting unread messages: {str(e)}")
+
+@click.command('sweep-reservations')
+@with_appcontext
+def sweep_reservations_command():
+    """Releases expired cart stock reservations (the web workers also do this in the background)."""
+    from reservations import release_expired
+
+    try:
+        released = release_expired()
+        click.echo(f"Released {released} expired cart reservations.")
+    except Exception as e:
+        db.session.rollback()
+        click.echo(f"Error releasing cart reservations: {str(e)}")
+
+@click.command('image-worker')
+@click.option('--processes', type=int, default=None, help='Worker processes (defaults to IMAGE_WORKER_PROCESSES, then the CPU count).')
+@click.option('--once', is_flag=True, help='Exit once the job queue is empty instead of polling for new jobs.')
+@with_appcontext
+def image_worker_command(processes, once):
+    """Generates resized image renditions queued by product image uploads."""
+    from jobs import run_worker
+
+    click.echo("Image worker started. Press Ctrl+C to stop." if not once else "Processing queued image jobs...")
+    try:
+        processed = run_worker(processes=processes, once=once)
+        click.echo(f"Processed {processed} image jobs.")
+    except KeyboardInterrupt:
+        click.echo("Image worker stopped.")
+
+@click.command('benchmark-uploads')
+@click.option('--requests', 'request_count', type=int, default=2000, help='Requests per serving mode.')
+@click.option('--size-kb', type=int, default=256, help='Size of the test image in KB.')
+@click.option('--mode', 'modes', multiple=True, help='Serving mode(s) to compare (default: all).')
+@with_appcontext
+def benchmark_uploads_command(request_count, size_kb, modes):
+    """Compares image serving throughput of the UPLOAD_SERVE_MODE options."""
+    import hashlib
+    import os
+    import shutil
+    import tempfile
+    import time
+    from flask import current_app
+    from werkzeug.test import EnvironBuilder
+    from cache import upload_stats
+    from routes import UPLOAD_SERVE_MODES
+
+    class SendfileWrapper:
+        """Stands in for a server's wsgi.file_wrapper: marks the file for os.sendfile."""
+        def __init__(self, file, block_size=8192):
+            self.file = file
+        def __iter__(self):
+            return iter(())
+        def close(self):
+            self.file.close()
+
+    app = current_app._get_current_object()
+    data = os.urandom(size_kb * 1024)
+    filename = f"{hashlib.sha256(data).hexdigest()}.jpg"
+    folder = tempfile.mkdtemp(prefix='upload-bench-')
+    saved_config = {key: app.config.get(key) for key in ('UPLOAD_FOLDER', 'UPLOAD_SERVE_MODE')}
+    try:
+        with open(os.path.join(folder, filename), 'wb') as f:
+            f.write(data)
+        app.config['UPLOAD_FOLDER'] = folder
+        upload_stats.invalidate()
+        environ = EnvironBuilder(path=f"/uploads/{filename}").get_environ()
+        environ['wsgi.file_wrapper'] = SendfileWrapper
+
+        click.echo(f"{request_count} requests of a {size_kb} KB image per mode (WSGI app called in-process;")
+        click.echo("file_wrapper bodies are sent with os.sendfile like a sendfile-capable server would).")
+        click.echo(f"{'mode':<18}{'req/s':>10}{'MB/s':>10}{'bytes via Python':>20}")
+        with open(os.devnull, 'wb') as sink:
+            for mode in modes or UPLOAD_SERVE_MODES:
+                app.config['UPLOAD_SERVE_MODE'] = mode
+                python_bytes = 0
+                started = time.perf_counter()
+                for _ in range(request_count):
+                    body = app(dict(environ), lambda status, headers, exc_info=None: None)
+                    try:
+                        if isinstance(body, SendfileWrapper):
+                            body.file.seek(0, os.SEEK_END)
+                            size, offset = body.file.tell(), 0
+                            while offset < size:
+                                offset += os.sendfile(sink.fileno(), body.file.fileno(), offset, size - offset)
+                        else:
+                            for chunk in body:
+                                python_bytes += len(chunk)
+                                sink.write(chunk)
+                    finally:
+                        if hasattr(body, 'close'):
+                            body.close()
+                elapsed = time.perf_counter() - started
+                served_mb = request_count * len(data) / (1024 * 1024)
+                click.echo(f"{mode:<18}{request_count / elapsed:>10.0f}{served_mb / elapsed:>10.1f}{python_bytes:>20}")
+        click.echo("x-sendfile/x-accel-redirect exclude the proxy's own send time; they show the worker cost only.")
+    finally:
+        app.config.update(saved_config)
+        upload_stats.invalidate()
+        shutil.rmtree(folder, ignore_errors=True)
+
+@click.command('build-assets')
+@click.option('--clean', is_flag=True, help='Remove fingerprinted files left over from earlier builds.')
+@with_appcontext
+def build_assets_command(clean):
+    """Fingerprints static files, writes gzip/brotli siblings and the asset manifest."""
+    from flask import current_app
+    from assets import brotli, build_assets
+    from extensions import assets
+
+    app = current_app._get_current_object()
+    try:
+        entries = build_assets(app.static_folder, app.static_url_path, clean=clean)
+    except Exception as e:
+        click.echo(f"Error building static assets: {str(e)}")
+        return
+    assets.load_manifest(app)
+    for source, entry in sorted(entries.items()):
+        encodings = ', '.join(entry['encodings']) or 'uncompressed'
+        click.echo(f"{source} -> {entry['path']} ({encodings})")
+    if brotli is None:
+        click.echo("Note: install 'brotli' to also write .br files.")
+    click.echo(f"Built {len(entries)} static assets. Restart the app to serve them.")
+
+@click.command('import-prices')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json']), default=None, help='Feed format (default: from the file extension).')
+@click.option('--batch-size', type=int, default=None, help='History rows per insert (defaults to PRICE_IMPORT_BATCH_SIZE).')
+@click.option('--dry-run', is_flag=True, help='Validate and time the import, then roll it back.')
+@with_appcontext
+def import_prices_command(path, fmt, batch_size, dry_run):
+    """Upserts market prices from a CSV or JSON feed and appends their history."""
+    from flask import current_app
+    from cache import price_board
+    from price_import import detect_format, import_file
+
+    batch_size = batch_size or current_app.config.get('PRICE_IMPORT_BATCH_SIZE', 1000)
+    try:
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            summary = import_file(f, fmt or detect_format(path), batch_size=batch_size, commit=not dry_run)
+    except Exception as e:
+        click.echo(f"Error importing market prices: {str(e)}")
+        return
+    if not dry_run:
+        price_board.invalidate()
+    for error in summary['errors']:
+        click.echo(error)
+    click.echo(f"{'Checked' if dry_run else 'Imported'} {summary['rows']} rows "
+               f"({summary['created']} new prices, {summary['updated']} updated, {summary['history']} history rows, "
+               f"{summary['skipped']} skipped) in {summary['seconds']:.2f}s: {summary['rows_per_second']:.0f} rows/s.")
+    if dry_run:
+        click.echo("Dry run: nothing was saved.")
+
+@click.command('rollup-prices')
+@click.option('--price-id', type=int, default=None, help='Only rebuild the rollups of this market price.')
+@with_appcontext
+def rollup_prices_command(price_id):
+    """Rebuilds the daily/weekly/monthly market price rollups from the price history."""
+    import time
+    from cache import price_board
+    from price_rollups import rebuild_rollups
+
+    started = time.perf_counter()
+    try:
+        read, written = rebuild_rollups(price_id=price_id)
+    except Exception as e:
+        click.echo(f"Error rebuilding market price rollups: {str(e)}")
+        return
+    price_board.invalidate()
+    elapsed = time.perf_counter() - started
+    click.echo(f"Rolled up {read} history rows into {written} rollup rows in {elapsed:.2f}s "
+               f"({read / elapsed if elapsed else 0:.0f} rows/s).")
+
 # Function to register commands with the app
 def register_commands(app):
     app.cli.add_command(create_admin_command)
+    app.cli.add_command(reindex_search_command)
+    app.cli.add_command(recount_unread_command)
+    app.cli.add_command(sweep_reservations_command)
+    app.cli.add_command(image_worker_command)
+    app.cli.add_command(benchmark_uploads_command)
+    app.cli.add_command(build_assets_command)
+    app.cli.add_command(import_prices_command)
+    app.cli.add_command(rollup_prices_command)
 
@@ -0,0 +1,117 @@
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # Optional: without it responses are only gzip-compressed
+    brotli = None
+
+
+class Compress:
+    """
+    Flask extension compressing responses with brotli or gzip, whichever the client prefers.
+
+    Only responses with a MIME type in COMPRESS_MIMETYPES are touched. Buffered responses
+    smaller than COMPRESS_MIN_SIZE bytes are sent as-is, since compression wouldn't pay off.
+    Streamed responses are compressed chunk by chunk and flushed after every chunk, so they
+    are never buffered and each chunk still reaches the client as soon as it is produced.
+    File responses (send_file) and anything already encoded, such as precompressed static
+    assets, pass through unchanged.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('COMPRESS_ENABLED', True):
+            app.after_request(self.compress_response)
+
+    def compress_response(self, response):
+        config = current_app.config
+        if (response.direct_passthrough
+                or response.status_code < 200 or response.status_code in (204, 206, 304)
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in config.get('COMPRESS_MIMETYPES', ())
+                or 'no-transform' in response.headers.get('Cache-Control', '')):
+            return response
+        # The body now depends on Accept-Encoding, whether or not this client gets it compressed
+        response.vary.add('Accept-Encoding')
+
+        encoding = self._choose_encoding(config)
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = self._compress_stream(response.response, encoding, config)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < config.get('COMPRESS_MIN_SIZE', 500):
+                return response
+            compressor = self._compressor(encoding, config)
+            response.set_data(compressor.compress(data) + compressor.finish())
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            # Same entity, different bytes: a strong validator would no longer be byte-exact
+            response.set_etag(etag, weak=True)
+        return response
+
+    @staticmethod
+    def _choose_encoding(config):
+        algorithms = [algorithm for algorithm in config.get('COMPRESS_ALGORITHMS', ('br', 'gzip'))
+                      if algorithm == 'gzip' or (algorithm == 'br' and brotli is not None)]
+        if not algorithms:
+            return None
+        # Ties go to the first match, i.e. the order of COMPRESS_ALGORITHMS
+        encoding = request.accept_encodings.best_match(algorithms + ['identity'])
+        return encoding if encoding in algorithms else None
+
+    def _compress_stream(self, chunks, encoding, config):
+        compressor = self._compressor(encoding, config)
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if chunk:
+                    yield compressor.compress(chunk) + compressor.flush()
+            yield compressor.finish()
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()  # Let the wrapped generator run its cleanup (e.g. unsubscribe a stream)
+
+    @staticmethod
+    def _compressor(encoding, config):
+        if encoding == 'br':
+            return _BrotliCompressor(config.get('COMPRESS_BR_LEVEL', 4))
+        return _GzipCompressor(config.get('COMPRESS_LEVEL', 6))
+
+
+class _GzipCompressor:
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliCompressor:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
@@ -29,8 +29,122 @@ class Config:
     # Optional: Maximum file size (e.g., 16 MB)
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024 # 16 Megabytes
 
+    # Resized WebP renditions of uploaded images (name -> longest side in pixels), stored
+    # under UPLOAD_FOLDER/derived. Templates pick the smallest that fits; needs Pillow.
+    IMAGE_RENDITIONS = {'thumb': 160, 'card': 480}
+    IMAGE_WEBP_QUALITY = int(os.environ.get('IMAGE_WEBP_QUALITY', 80))
+    # 'background' queues renditions for 'flask image-worker' (listings show a placeholder
+    # until they're ready); 'inline' generates them during the upload request
+    IMAGE_PROCESSING = os.environ.get('IMAGE_PROCESSING', 'background')
+    # Worker processes for 'flask image-worker' (0 = one per CPU)
+    IMAGE_WORKER_PROCESSES = int(os.environ.get('IMAGE_WORKER_PROCESSES', 0))
+    # Seconds an idle worker waits before checking the job table again
+    IMAGE_WORKER_POLL_INTERVAL = int(os.environ.get('IMAGE_WORKER_POLL_INTERVAL', 2))
+    # Seconds before a job claimed by a worker that stopped responding is retried
+    IMAGE_JOB_TIMEOUT = int(os.environ.get('IMAGE_JOB_TIMEOUT', 300))
+    IMAGE_JOB_MAX_ATTEMPTS = int(os.environ.get('IMAGE_JOB_MAX_ATTEMPTS', 3))
+    # Seconds a freshly stored image is kept even if no listing references it yet, so a
+    # concurrent upload of the same content can commit its listing before it is deleted
+    IMAGE_DISCARD_GRACE = int(os.environ.get('IMAGE_DISCARD_GRACE', 60))
+    # Browser cache lifetime (seconds) for content-hashed uploads, sent as 'immutable'
+    UPLOAD_CACHE_MAX_AGE = int(os.environ.get('UPLOAD_CACHE_MAX_AGE', 365 * 24 * 3600))
+    # Seconds each worker remembers an upload's size/mtime (or that it's missing)
+    UPLOAD_STAT_CACHE_TTL = int(os.environ.get('UPLOAD_STAT_CACHE_TTL', 60))
+    # How upload bytes are sent: 'file_wrapper' (the WSGI server's sendfile, e.g. gunicorn),
+    # 'python' (streamed by the worker), 'x-sendfile' (Apache mod_xsendfile / lighttpd) or
+    # 'x-accel-redirect' (nginx; needs an internal location at UPLOAD_ACCEL_PREFIX aliased
+    # to UPLOAD_FOLDER). Compare them with 'flask benchmark-uploads'.
+    UPLOAD_SERVE_MODE = os.environ.get('UPLOAD_SERVE_MODE', 'file_wrapper')
+    UPLOAD_ACCEL_PREFIX = os.environ.get('UPLOAD_ACCEL_PREFIX', '/protected-uploads/')
+
     # --- End Upload Configuration ---
 
+    # --- Static Asset Configuration ---
+    # Browser cache lifetime (seconds) for fingerprinted static files written by
+    # 'flask build-assets'; they are served as 'immutable'
+    STATIC_CACHE_MAX_AGE = int(os.environ.get('STATIC_CACHE_MAX_AGE', 365 * 24 * 3600))
+    # --- End Static Asset Configuration ---
+
+    # --- Response Compression Configuration ---
+    COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    # Preferred encodings, best first ('br' needs the optional 'brotli' package)
+    COMPRESS_ALGORITHMS = ('br', 'gzip')
+    # Only these response types are compressed; images and files are left alone
+    COMPRESS_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/xml', 'text/csv',
+                          'application/json', 'application/javascript', 'application/xml', 'image/svg+xml'}
+    # Buffered responses smaller than this (bytes) aren't worth compressing
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+    # gzip level (1-9) and brotli quality (0-11); moderate values keep per-request CPU low
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+    COMPRESS_BR_LEVEL = int(os.environ.get('COMPRESS_BR_LEVEL', 4))
+    # --- End Response Compression Configuration ---
+
+    # --- Market Price Configuration ---
+    # Points returned by /api/prices/history/<id> when the client doesn't ask for a number,
+    # and the most it may ask for; longer ranges are downsampled or bucketed
+    PRICE_HISTORY_DEFAULT_POINTS = int(os.environ.get('PRICE_HISTORY_DEFAULT_POINTS', 300))
+    PRICE_HISTORY_MAX_POINTS = int(os.environ.get('PRICE_HISTORY_MAX_POINTS', 1000))
+    # Seconds before the cached price board is reloaded even without a write. Bounds how
+    # long writes from other processes take to show up when CACHE_VERSION_URL is 'memory://'
+    PRICE_BOARD_CACHE_TTL = int(os.environ.get('PRICE_BOARD_CACHE_TTL', 300))
+    # Rendered /market-prices tables kept per process, one per search term (LRU)
+    PRICE_FRAGMENT_CACHE_SIZE = int(os.environ.get('PRICE_FRAGMENT_CACHE_SIZE', 256))
+    # Where cache version numbers (price board, logged-in users) live: 'memory://' for one process,
+    # or a Redis URL (requires the 'redis' package) so writes invalidate every worker's caches
+    CACHE_VERSION_URL = os.environ.get('CACHE_VERSION_URL', 'memory://')
+    # History rows per INSERT when importing a price feed (flask import-prices, /admin/prices/import)
+    PRICE_IMPORT_BATCH_SIZE = int(os.environ.get('PRICE_IMPORT_BATCH_SIZE', 1000))
+    # --- End Market Price Configuration ---
+
+    # --- Catalog Configuration ---
+    # Number of listings per page on /products. Pages are keyset-paginated on
+    # (created_at, id), so every page costs the same no matter how deep it is.
+    PRODUCTS_PER_PAGE = int(os.environ.get('PRODUCTS_PER_PAGE', 24))
+
+    # Product search backend: 'auto' uses PostgreSQL full-text search when the
+    # database is PostgreSQL and the in-process inverted index otherwise.
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'auto')
+    # Upper bound on ranked search results (and so on pages reachable from one search)
+    SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 500))
+    # Seconds before the in-process index is rebuilt to pick up other workers' writes
+    SEARCH_INDEX_MAX_AGE = int(os.environ.get('SEARCH_INDEX_MAX_AGE', 300))
+    # Seconds the category facet list (with active listing counts) is cached per worker
+    FACET_CACHE_TTL = int(os.environ.get('FACET_CACHE_TTL', 60))
+    # --- End Catalog Configuration ---
+
+    # --- Messaging Configuration ---
+    # Number of messages loaded when opening a conversation and per "load older" request
+    MESSAGES_PER_PAGE = int(os.environ.get('MESSAGES_PER_PAGE', 50))
+    # Pub/sub backend for real-time message streams: 'memory://' works within a single
+    # process; use a Redis URL (requires the 'redis' package) with several workers.
+    MESSAGE_BROKER_URL = os.environ.get('MESSAGE_BROKER_URL', 'memory://')
+    # Seconds between keep-alive comments on an idle event stream
+    SSE_HEARTBEAT_SECONDS = int(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+    # Seconds before a stream is closed; browsers reconnect and catch up automatically
+    SSE_STREAM_TIMEOUT = int(os.environ.get('SSE_STREAM_TIMEOUT', 300))
+    # An open stream occupies a whole sync worker (e.g. gunicorn's default worker class), so
+    # there streams become long polls that end after the first event or this many seconds.
+    # 'auto' detects threaded and gevent/eventlet servers; 'stream' or 'long-poll' force a mode.
+    SSE_STREAM_MODE = os.environ.get('SSE_STREAM_MODE', 'auto')
+    SSE_LONG_POLL_TIMEOUT = int(os.environ.get('SSE_LONG_POLL_TIMEOUT', 20))
+    # --- End Messaging Configuration ---
+
+    # --- Cart Configuration ---
+    # Seconds stock added to a cart stays held for that buyer; each cart change renews it
+    CART_RESERVATION_TTL = int(os.environ.get('CART_RESERVATION_TTL', 900))
+    # Seconds between background sweeps releasing expired holds (0 disables the sweeper;
+    # run 'flask sweep-reservations' from cron instead)
+    RESERVATION_SWEEP_INTERVAL = int(os.environ.get('RESERVATION_SWEEP_INTERVAL', 60))
+    # --- End Cart Configuration ---
+
+    # --- Login Configuration ---
+    # Seconds a logged-in user's record is reused per worker without a change being seen
+    # (edits bump its version in CACHE_VERSION_URL, so with Redis they apply at once)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300))
+    # Users kept in each worker's cache (least recently active are dropped first)
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1000))
+    # --- End Login Configuration ---
+
 # Note on os.makedirs: Creating the directory directly in config.py might run
 # prematurely during imports. It's often safer to ensure the directory exists
 # within your application factory (`create_app` in app.py) or just before
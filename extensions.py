@@ -2,9 +2,15 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt # type: ignore
 from flask_login import LoginManager # type: ignore
 from flask_migrate import Migrate
+from broker import MessageBroker
+from assets import StaticAssets
+from compression import Compress
 
 # Initialize extensions
 db = SQLAlchemy()
 bcrypt = Bcrypt()
 login_manager = LoginManager()
 migrate = Migrate()
+broker = MessageBroker()
+assets = StaticAssets()
+compress = Compress()
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from flask import current_app, url_for
+
+from cache import upload_stats
+from extensions import db
+from models import ImageJob, ProductListing
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Listed in requirements.txt; if it's missing, every rendition falls back to the original
+    Image = None
+
+DERIVED_DIR = 'derived'
+HASH_CHUNK_SIZE = 64 * 1024
+# Canonical extension per upload type, so identical content always gets one name
+EXTENSION_ALIASES = {'jpeg': 'jpg'}
+
+
+def store_image(file):
+    """
+    Saves an uploaded image under the SHA-256 of its content and returns that filename.
+    Identical uploads map to one file, names never collide, and a stored file never changes
+    (so it can be cached forever). The upload is streamed to a temporary file while hashing,
+    then moved into place atomically. The copy replaces an existing file (same bytes), so an
+    image a concurrent discard_image just deleted is restored, and its fresh mtime tells
+    discard_image to keep it until this request has committed the listing using it.
+    """
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    os.makedirs(upload_folder, exist_ok=True)
+    extension = file.filename.rsplit('.', 1)[1].lower()
+    extension = EXTENSION_ALIASES.get(extension, extension)
+
+    digest = hashlib.sha256()
+    handle, temp_path = tempfile.mkstemp(dir=upload_folder, suffix='.part')
+    try:
+        with os.fdopen(handle, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                out.write(chunk)
+        filename = f"{digest.hexdigest()}.{extension}"
+        target = os.path.join(upload_folder, filename)
+        os.replace(temp_path, target)
+        upload_stats.invalidate(target)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return filename
+
+
+def rendition_filename(filename, rendition):
+    """Path (relative to UPLOAD_FOLDER) of a WebP derivative, e.g. derived/<hash>-card.webp."""
+    stem = filename.rsplit('.', 1)[0]
+    return f"{DERIVED_DIR}/{stem}-{rendition}.webp"
+
+
+def generate_renditions(filename, renditions=None):
+    """
+    Writes the WebP derivatives of a stored image that don't exist yet and returns the
+    names of those available. Returns [] without Pillow or for unreadable images.
+    """
+    if Image is None:
+        return []
+    sizes = current_app.config.get('IMAGE_RENDITIONS', {})
+    targets = {rendition: sizes[rendition] for rendition in (renditions or sizes)}
+    return render_renditions(current_app.config['UPLOAD_FOLDER'], filename, targets,
+                             current_app.config.get('IMAGE_WEBP_QUALITY', 80))
+
+
+def render_renditions(upload_folder, filename, sizes, quality):
+    """
+    Does the work of generate_renditions for {rendition: longest side}. Needs no app context,
+    so the image worker can run it in a separate process.
+    """
+    if Image is None:
+        return []
+    source_path = os.path.join(upload_folder, filename)
+    os.makedirs(os.path.join(upload_folder, DERIVED_DIR), exist_ok=True)
+
+    done = []
+    source = None
+    try:
+        for rendition, size in sizes.items():
+            target = os.path.join(upload_folder, rendition_filename(filename, rendition))
+            if os.path.exists(target):
+                done.append(rendition)
+                continue
+            if source is None:
+                source = ImageOps.exif_transpose(Image.open(source_path))
+                if source.mode not in ('RGB', 'RGBA'):
+                    source = source.convert('RGBA' if 'transparency' in source.info else 'RGB')
+            image = source.copy()
+            image.thumbnail((size, size))
+            # Write next to the target and rename, so concurrent generators never expose a partial file
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.part')
+            os.close(handle)
+            try:
+                image.save(temp_path, 'WEBP', quality=quality)
+                os.replace(temp_path, target)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            done.append(rendition)
+    except (OSError, ValueError) as e:
+        print(f"Error generating renditions for {filename}: {e}")
+    return done
+
+
+def renditions_exist(filename):
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    return all(os.path.exists(os.path.join(upload_folder, rendition_filename(filename, rendition)))
+               for rendition in current_app.config.get('IMAGE_RENDITIONS', {}))
+
+
+def image_url(filename, rendition='card'):
+    """URL of the smallest suitable rendition of an uploaded image (for templates)."""
+    if not filename:
+        return None
+    if rendition not in current_app.config.get('IMAGE_RENDITIONS', {}):
+        return url_for('main.uploaded_file', filename=filename)
+    return url_for('main.image_rendition', rendition=rendition, filename=filename)
+
+
+def discard_image(filename):
+    """
+    Deletes a stored image and its derivatives once no listing references it any more.
+    Content-addressed files can be shared by several listings. Call after the commit
+    that dropped the reference. An image stored in the last IMAGE_DISCARD_GRACE seconds is
+    kept: an upload of the same content may not have committed its listing yet.
+    """
+    if not filename:
+        return
+    if db.session.query(ProductListing.id).filter_by(image_filename=filename).first():
+        return
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    try:
+        stored_at = os.path.getmtime(os.path.join(upload_folder, filename))
+    except OSError:
+        stored_at = None
+    if stored_at is not None and time.time() - stored_at < current_app.config.get('IMAGE_DISCARD_GRACE', 60):
+        return
+    try:
+        ImageJob.query.filter_by(filename=filename).delete()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error deleting image job for {filename}: {e}")
+    paths = [filename] + [rendition_filename(filename, rendition)
+                          for rendition in current_app.config.get('IMAGE_RENDITIONS', {})]
+    for path in paths:
+        filepath = os.path.join(upload_folder, path)
+        upload_stats.invalidate(filepath)
+        try:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+                print(f"Deleted image file: {filepath}")
+        except OSError as e:
+            print(f"Error deleting image file {filepath}: {e}")
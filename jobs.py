@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from images import Image, generate_renditions, render_renditions, renditions_exist
+from models import ImageJob, ProductListing
+
+
+def queue_renditions(filename, retry_failed=True):
+    """
+    Arranges for the renditions of a stored image to be generated and returns True if they
+    are ready now, i.e. the value for listing.image_ready. In 'background' mode the job row is
+    added to the session and the caller commits it together with the listing. A job that ran
+    out of attempts is only retried with retry_failed (a new upload of the image).
+    """
+    if not filename:
+        return True
+    if Image is None:
+        warn_missing_pillow()
+        return True  # Nothing can be generated: the rendition route serves the original
+    if renditions_exist(filename):
+        return True  # Same image uploaded before
+    if current_app.config.get('IMAGE_PROCESSING', 'background') != 'background':
+        generate_renditions(filename)
+        return True
+
+    job = ImageJob.query.filter_by(filename=filename).first()
+    if job is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(ImageJob(filename=filename))
+        except IntegrityError:
+            pass  # An identical upload queued it at the same moment
+    elif job.status == 'done' or (job.status == 'failed' and retry_failed):
+        # Its renditions were deleted since, or the last run failed: run it again
+        job.status = 'pending'
+        job.attempts = 0
+        job.error = None
+    return False
+
+
+_warned_missing_pillow = False
+
+
+def warn_missing_pillow():
+    """Logs, once per process, that images are served full size because Pillow isn't installed."""
+    global _warned_missing_pillow
+    if _warned_missing_pillow:
+        return
+    _warned_missing_pillow = True
+    current_app.logger.warning(
+        "Pillow is not installed: no image renditions are queued or generated, so pages load the "
+        f"original uploads (IMAGE_PROCESSING={current_app.config.get('IMAGE_PROCESSING', 'background')!r}). "
+        "Install it with 'pip install -r requirements.txt'.")
+
+
+# When this process last had the rendition route check an image's job: filename -> monotonic time
+_requested = OrderedDict()
+_requested_lock = threading.Lock()
+MAX_REQUESTED = 10000
+
+
+def request_renditions(filename):
+    """
+    queue_renditions for the rendition route, when a rendition file is missing: queues images
+    uploaded before renditions existed and done jobs whose files were deleted, but leaves
+    failed jobs alone. Each process checks an image's job at most once per
+    UPLOAD_STAT_CACHE_TTL seconds, so requests for a missing rendition don't each query and
+    commit. Returns True if the renditions are ready now.
+    """
+    ttl = current_app.config.get('UPLOAD_STAT_CACHE_TTL', 60)
+    now = time.monotonic()
+    with _requested_lock:
+        checked_at = _requested.get(filename)
+        if checked_at is not None and now - checked_at < ttl:
+            return False
+        _requested[filename] = now
+        _requested.move_to_end(filename)
+        while len(_requested) > MAX_REQUESTED:
+            _requested.popitem(last=False)
+    try:
+        ready = queue_renditions(filename, retry_failed=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error queueing renditions for {filename}: {e}")
+        return False
+    return ready
+
+
+def claim_jobs(limit):
+    """Marks up to `limit` pending (or abandoned) jobs as running and returns their (id, filename)."""
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=current_app.config.get('IMAGE_JOB_TIMEOUT', 300))
+    jobs = ImageJob.query.filter(or_(
+        ImageJob.status == 'pending',
+        # A worker that died mid-job leaves it 'running'; retry once the claim is old enough
+        and_(ImageJob.status == 'running', ImageJob.locked_at < stale_before)
+    )).order_by(ImageJob.id).limit(limit).with_for_update(skip_locked=True).all()
+    for job in jobs:
+        job.status = 'running'
+        job.locked_at = now
+        job.attempts += 1
+    claimed = [(job.id, job.filename) for job in jobs]
+    db.session.commit()
+    return claimed
+
+
+def finish_job(job_id, error=None):
+    """Records a job's outcome. Listings are marked ready once it is done or out of retries."""
+    job = db.session.get(ImageJob, job_id)
+    if job is None:
+        return  # The image was discarded while we worked on it
+    if error is None:
+        job.status = 'done'
+        job.error = None
+    elif job.attempts < current_app.config.get('IMAGE_JOB_MAX_ATTEMPTS', 3):
+        job.status = 'pending'
+        job.error = error
+    else:
+        # Give up; the rendition route falls back to the original image
+        job.status = 'failed'
+        job.error = error
+    job.locked_at = None
+    db.session.flush()
+    if job.status != 'pending':
+        mark_images_ready()
+    db.session.commit()
+
+
+def mark_images_ready():
+    """
+    Sets image_ready on listings whose image job has finished. Done for every finished job,
+    not only the current one, so a listing committed while its job was running is picked up too.
+    """
+    finished = db.select(ImageJob.filename).where(ImageJob.status.in_(('done', 'failed')))
+    result = db.session.execute(
+        db.update(ProductListing)
+        .where(ProductListing.image_ready.is_(False), ProductListing.image_filename.in_(finished))
+        # Finishing a thumbnail isn't an edit of the listing, so keep updated_at as is
+        .values(image_ready=True, updated_at=ProductListing.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def run_worker(processes=None, once=False):
+    """
+    Runs image jobs on a pool of `processes` worker processes, polling the job table for new
+    work. The web process only stores the upload and queues a job; decoding and resizing
+    happen here. With once=True, returns when the queue is empty. Returns the jobs processed.
+    """
+    config = current_app.config
+    processes = processes or config.get('IMAGE_WORKER_PROCESSES') or os.cpu_count() or 1
+    poll_interval = config.get('IMAGE_WORKER_POLL_INTERVAL', 2)
+    sizes = dict(config.get('IMAGE_RENDITIONS', {}))
+    upload_folder = config['UPLOAD_FOLDER']
+    quality = config.get('IMAGE_WEBP_QUALITY', 80)
+
+    processed = 0
+    running = {}  # future -> job id
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        while True:
+            # Only claim what the pool can start now, so claims don't go stale in a backlog
+            if len(running) < processes:
+                for job_id, filename in claim_jobs(processes - len(running)):
+                    future = pool.submit(render_renditions, upload_folder, filename, sizes, quality)
+                    running[future] = job_id
+
+            if not running:
+                mark_images_ready()
+                db.session.commit()
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            finished, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job_id = running.pop(future)
+                try:
+                    done = future.result()
+                    error = None if len(done) == len(sizes) else "Could not generate every rendition"
+                except Exception as e:
+                    error = str(e)
+                try:
+                    finish_job(job_id, error)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error recording image job {job_id}: {e}")
+                processed += 1
+    return processed
@@ -4,8 +4,18 @@ from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 import decimal
 
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.hybrid import hybrid_property
+
 from extensions import db
 
+
+def clamped_increment(column, delta):
+    """SQL expression for `column + delta` that never drops below zero (for denormalized counters)."""
+    new_value = column + delta
+    return db.case((new_value < 0, 0), else_=new_value)
+
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
 
@@ -20,6 +30,9 @@ class User(UserMixin, db.Model):
     address = db.Column(db.String(200), nullable=True)
     farmer_type = db.Column(db.String(50), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Denormalized count of unread messages addressed to this user, kept in step by
+    # adjust_unread_count so the navbar badge doesn't need a COUNT query per page.
+    unread_message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     crops = db.relationship('Crop', backref='owner', lazy=True, cascade="all, delete-orphan")
     livestock = db.relationship('Livestock', backref='owner', lazy=True, cascade="all, delete-orphan")
@@ -61,6 +74,21 @@ class User(UserMixin, db.Model):
     def is_admin(self):
         return self.role == 'admin'
 
+    @staticmethod
+    def adjust_unread_count(user_id, delta):
+        """
+        Atomically adds delta to a user's unread message counter in the current transaction,
+        never going below zero. The caller commits together with the message change.
+        """
+        if not user_id or not delta:
+            return
+        db.session.execute(
+            db.update(User)
+            .where(User.id == user_id)
+            .values(unread_message_count=clamped_increment(User.unread_message_count, delta))
+            .execution_options(synchronize_session=False)
+        )
+
 class FarmerNote(db.Model):
     __tablename__ = 'farmer_note'
 
@@ -96,11 +124,67 @@ class ProductListing(db.Model):
     price = db.Column(db.Float, nullable=False)
     unit = db.Column(db.String(50), nullable=False)
     quantity_available = db.Column(db.Float, nullable=False)
+    # Stock held by active cart reservations (see reservations.py). Denormalized so catalog
+    # cards can show effective availability straight from the listing row.
+    quantity_reserved = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
     image_filename = db.Column(db.String(255), nullable=True)
+    # False while the image worker is still producing the resized renditions; cards show a placeholder
+    image_ready = db.Column(db.Boolean, nullable=False, default=True, server_default=db.true())
     status = db.Column(db.String(30), nullable=False, default='pending_approval')
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Weighted full-text document (name > category > description), maintained by search.py on PostgreSQL.
+    # Plain text and unused on other databases, which fall back to the in-process index.
+    search_vector = db.Column(db.Text().with_variant(TSVECTOR(), 'postgresql'), nullable=True)
+
+    __table_args__ = (
+        # Backs the keyset-paginated catalog: WHERE status = ? ORDER BY created_at DESC, id DESC
+        db.Index('ix_product_listing_status_created_at_id', 'status', 'created_at', 'id'),
+        db.Index('ix_product_listing_search_vector', 'search_vector', postgresql_using='gin'),
+    )
+
+    @property
+    def available_quantity(self):
+        """Stock that can still be added to carts: quantity_available minus active reservations."""
+        return max((self.quantity_available or 0) - (self.quantity_reserved or 0), 0)
+
+    @staticmethod
+    def lock_for_checkout(product_ids):
+        """
+        Loads the given listings with a single SELECT ... FOR UPDATE, locking rows in id order
+        so concurrent checkouts always lock in the same order and cannot deadlock.
+        Returns {listing_id: listing} with freshly loaded values.
+        """
+        if not product_ids:
+            return {}
+        listings = ProductListing.query.filter(ProductListing.id.in_(product_ids)) \
+            .order_by(ProductListing.id).with_for_update().populate_existing().all()
+        return {listing.id: listing for listing in listings}
+
+    @staticmethod
+    def decrement_stock(quantities, held=None):
+        """
+        Subtracts {listing_id: quantity} from quantity_available with one guarded bulk UPDATE,
+        consuming the buyer's own reservations {listing_id: held quantity} at the same time.
+        A row is only updated if it still has enough stock not held by other carts, so the
+        result is correct even where row locks are unavailable (e.g. SQLite).
+        Returns True if every listing was decremented.
+        """
+        if not quantities:
+            return True
+        held = {listing_id: held.get(listing_id, 0.0) for listing_id in quantities} if held else {}
+        requested = db.case(quantities, value=ProductListing.id)
+        own_hold = db.case(held, value=ProductListing.id) if held else 0.0
+        result = db.session.execute(
+            db.update(ProductListing)
+            .where(ProductListing.id.in_(list(quantities)),
+                   ProductListing.quantity_available - (ProductListing.quantity_reserved - own_hold) >= requested)
+            .values(quantity_available=ProductListing.quantity_available - requested,
+                    quantity_reserved=clamped_increment(ProductListing.quantity_reserved, -own_hold))
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount == len(quantities)
 
 class MarketPrice(db.Model):
     __tablename__ = 'market_price'
@@ -122,6 +206,42 @@ class MarketPriceHistory(db.Model):
     date = db.Column(db.DateTime, default=datetime.utcnow)
     market_price = db.relationship('MarketPrice', backref=db.backref('history', lazy=True))
 
+    __table_args__ = (
+        # Range scans for one price's chart (and deletes by price) without a full table scan
+        db.Index('ix_market_price_history_market_price_id_date', 'market_price_id', 'date'),
+    )
+
+class MarketPriceRollup(db.Model):
+    """
+    Daily, weekly (Monday-start) and monthly aggregates of MarketPriceHistory per market price,
+    kept up to date as history is appended (see price_rollups), so trend views read one row per
+    period instead of scanning raw history. Rebuild with 'flask rollup-prices'.
+    """
+    __tablename__ = 'market_price_rollups'
+
+    id = db.Column(db.Integer, primary_key=True)
+    market_price_id = db.Column(db.Integer, db.ForeignKey('market_price.id', ondelete='CASCADE'), nullable=False)
+    period = db.Column(db.String(10), nullable=False)  # 'day', 'week' or 'month'
+    period_start = db.Column(db.Date, nullable=False)
+    min_price = db.Column(db.Float, nullable=False)
+    max_price = db.Column(db.Float, nullable=False)
+    # Sum and count rather than the average itself, so new rows can be folded in
+    sum_price = db.Column(db.Float, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    first_price = db.Column(db.Float, nullable=False)
+    first_date = db.Column(db.DateTime, nullable=False)
+    last_price = db.Column(db.Float, nullable=False)
+    last_date = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('market_price_id', 'period', 'period_start',
+                            name='uq_market_price_rollups_price_period_start'),
+    )
+
+    @property
+    def avg_price(self):
+        return self.sum_price / self.count if self.count else None
+
 class Conversation(db.Model):
     __tablename__ = 'conversations'
 
@@ -132,13 +252,25 @@ class Conversation(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    # Denormalized inbox fields, maintained by register_message / mark_read_by so the
+    # inbox can be rendered from a single query without touching the messages table.
+    last_message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='SET NULL', use_alter=True, name='fk_conversations_last_message_id'),
+        nullable=True
+    )
+    unread_count_buyer = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    unread_count_farmer = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     product_listing = db.relationship('ProductListing', backref=db.backref('conversations', lazy=True))
     messages = db.relationship(
         'Message',
         back_populates='conversation',
+        foreign_keys='Message.conversation_id',
         cascade="all, delete-orphan",
         lazy='dynamic'
     )
+    last_message = db.relationship('Message', foreign_keys=[last_message_id], viewonly=True)
 
     # Updated relationships with back_populates
     buyer = db.relationship(
@@ -165,6 +297,74 @@ class Conversation(db.Model):
         else:
             return None  # Current user is not part of this conversation
 
+    def unread_count_for(self, user_id):
+        """Returns the number of messages in this conversation that the given participant hasn't read."""
+        if user_id == self.buyer_id:
+            return self.unread_count_buyer or 0
+        elif user_id == self.farmer_id:
+            return self.unread_count_farmer or 0
+        return 0
+
+    def _unread_column_for(self, user_id):
+        if user_id == self.buyer_id:
+            return Conversation.unread_count_buyer
+        elif user_id == self.farmer_id:
+            return Conversation.unread_count_farmer
+        return None
+
+    def register_message(self, message):
+        """
+        Updates the denormalized inbox fields and the recipient's unread counter for a
+        newly added message, atomically and in the current transaction. The caller commits.
+        """
+        if message.id is None:
+            db.session.flush()  # Assigns message.id
+        values = {
+            # Keep the newest message even if concurrent senders commit out of order
+            'last_message_id': db.case(
+                (db.or_(Conversation.last_message_id.is_(None), Conversation.last_message_id < message.id), message.id),
+                else_=Conversation.last_message_id
+            )
+        }
+        unread_column = self._unread_column_for(message.recipient_id)
+        if unread_column is not None:
+            values[unread_column.key] = clamped_increment(unread_column, 1)
+        db.session.execute(
+            db.update(Conversation).where(Conversation.id == self.id).values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        User.adjust_unread_count(message.recipient_id, 1)
+
+    def mark_read_by(self, user_id):
+        """
+        Marks every unread message addressed to user_id in this conversation as read with a
+        single set-based UPDATE, and subtracts them from the reader's conversation and user
+        counters in the same transaction. Returns the number of messages marked. The caller commits.
+        """
+        unread_column = self._unread_column_for(user_id)
+        if unread_column is None:
+            return 0
+        result = db.session.execute(
+            db.update(Message)
+            .where(Message.conversation_id == self.id,
+                   Message.recipient_id == user_id,
+                   Message.is_read.is_(False))
+            .values(is_read=True)
+            .execution_options(synchronize_session=False)
+        )
+        count = result.rowcount
+        if not count:
+            return 0
+        db.session.execute(
+            db.update(Conversation).where(Conversation.id == self.id)
+            # Reading shouldn't bump the conversation up the inbox, so keep updated_at as is
+            .values({unread_column.key: clamped_increment(unread_column, -count),
+                     'updated_at': Conversation.updated_at})
+            .execution_options(synchronize_session=False)
+        )
+        User.adjust_unread_count(user_id, -count)
+        return count
+
 class Message(db.Model):
     __tablename__ = 'messages'
 
@@ -176,10 +376,16 @@ class Message(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     is_read = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        # Backs windowed thread loading: WHERE conversation_id = ? ORDER BY timestamp DESC LIMIT n
+        db.Index('ix_messages_conversation_id_timestamp', 'conversation_id', 'timestamp'),
+    )
+
     # ✅ Proper back reference to Conversation
     conversation = db.relationship(
         'Conversation',
-        back_populates='messages'
+        back_populates='messages',
+        foreign_keys=[conversation_id]
     )
 
     sender = db.relationship('User', foreign_keys=[sender_id])
@@ -200,14 +406,37 @@ class Cart(db.Model):
     # Relationship to CartItem (one-to-many)
     items = db.relationship('CartItem', backref='cart', lazy='dynamic', cascade="all, delete-orphan")
 
-    @property
+    @hybrid_property
     def total_price(self):
-        """Calculates the total price of all items in the cart."""
+        """Total price of all items in the cart, computed in the database with one SUM query."""
+        total = db.session.scalar(
+            db.select(Cart._item_total_sum()).select_from(CartItem)
+            .join(ProductListing, CartItem.product_id == ProductListing.id)
+            .where(CartItem.cart_id == self.id)
+        )
+        return float(total or 0)
+
+    @total_price.inplace.expression
+    @classmethod
+    def _total_price_expression(cls):
+        # Correlated subquery, so carts can be selected/filtered by total in SQL
+        return db.select(cls._item_total_sum()).select_from(CartItem) \
+            .join(ProductListing, CartItem.product_id == ProductListing.id) \
+            .where(CartItem.cart_id == cls.id) \
+            .scalar_subquery()
+
+    @staticmethod
+    def _item_total_sum():
+        return db.func.coalesce(db.func.sum(ProductListing.price * CartItem.quantity), 0)
+
+    @staticmethod
+    def total_for_items(items):
+        """Calculates the cart total from already-loaded items (with products) without querying."""
         total = decimal.Decimal(0.0)
-        for item in self.items:
-             # Ensure item.product and item.product.price are not None
+        for item in items:
+            # Ensure item.product and item.product.price are not None
             if item.product and item.product.price is not None and item.quantity is not None:
-                 total += decimal.Decimal(item.product.price) * decimal.Decimal(item.quantity)
+                total += decimal.Decimal(item.product.price) * decimal.Decimal(item.quantity)
         # Convert back to float for compatibility if necessary, or keep as Decimal
         return float(total)
 
@@ -223,6 +452,10 @@ class CartItem(db.Model):
     product = db.relationship('ProductListing', passive_deletes=True)
     quantity = db.Column(db.Float, nullable=False, default=1.0) # Or db.Integer if whole units only
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Temporary stock hold for this item (see reservations.py). reserved_quantity is what is
+    # currently counted in the product's quantity_reserved; 0 once released or consumed.
+    reserved_quantity = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+    reserved_until = db.Column(db.DateTime, nullable=True, index=True)
 
     # Relationship to ProductListing
     # Ensures we can easily access product details from the cart item
@@ -284,4 +517,61 @@ class OrderItem(db.Model):
 
 
     def __repr__(self):
-        return f"<OrderItem ID: {self.id}, OrderID: {self.order_id}, Product: {self.product_name}, Qty: {self.quantity}>"
\ No newline at end of file
+        return f"<OrderItem ID: {self.id}, OrderID: {self.order_id}, Product: {self.product_name}, Qty: {self.quantity}>"
+
+class OrderIdempotencyKey(db.Model):
+    """
+    One row per checkout attempt key a client sent. The unique (user_id, key) constraint makes
+    a replayed or concurrent duplicate submission fail fast instead of placing a second order.
+    """
+    __tablename__ = 'order_idempotency_keys'
+    MAX_LENGTH = 64
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    key = db.Column(db.String(MAX_LENGTH), nullable=False)
+    # Set in the same transaction that creates the order, so a committed key always has one
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id', ondelete='CASCADE'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'key', name='uq_order_idempotency_keys_user_id_key'),
+    )
+
+    @staticmethod
+    def find_order_id(user_id, key):
+        """Returns the id of the order already placed with this key, or None."""
+        return db.session.query(OrderIdempotencyKey.order_id) \
+            .filter_by(user_id=user_id, key=key).scalar()
+
+    @staticmethod
+    def claim(user_id, key):
+        """
+        Inserts the key inside the current transaction. A concurrent request with the same key
+        waits on the unique index and then raises IntegrityError once this one commits.
+        """
+        claimed = OrderIdempotencyKey(user_id=user_id, key=key)
+        db.session.add(claimed)
+        db.session.flush()
+        return claimed
+
+    def __repr__(self):
+        return f"<OrderIdempotencyKey {self.key} UserID: {self.user_id} OrderID: {self.order_id}>"
+
+
+class ImageJob(db.Model):
+    """
+    Queue of image processing work (resized renditions of an uploaded image), run outside the
+    request by 'flask image-worker'. One row per stored image: identical uploads share a job.
+    """
+    __tablename__ = 'image_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), nullable=False, unique=True)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True) # pending, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True) # When a worker claimed it; stale claims are retried
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ImageJob {self.filename} ({self.status})>"
@@ -0,0 +1,131 @@
+import threading
+from collections import defaultdict, namedtuple
+
+from flask import g
+
+from cache import price_board
+from search import tokenize
+
+# Spellings of the same unit, so "1 kilo" listings compare with "kg" market prices
+UNIT_ALIASES = {'kilo': 'kg', 'kilos': 'kg', 'kilogram': 'kg', 'kilograms': 'kg', 'kgs': 'kg',
+                'pc': 'piece', 'pcs': 'piece', 'pieces': 'piece', 'l': 'liter', 'litre': 'liter',
+                'liters': 'liter', 'litres': 'liter', 'bundles': 'bundle', 'dozens': 'dozen'}
+
+# Official price of a commodity, averaged over the locations it is reported for
+MarketReference = namedtuple('MarketReference', 'name category unit price locations tokens')
+# What a catalog card shows: the reference and how far the listing's price is from it
+MarketComparison = namedtuple('MarketComparison', 'name unit market_price delta percent locations')
+
+
+def normalize_unit(unit):
+    unit = (unit or '').strip().lower().rstrip('.')
+    return UNIT_ALIASES.get(unit, unit)
+
+
+class PriceComparisonIndex:
+    """
+    Matches product listings to official market prices, so catalog cards can show how a
+    listing's price compares without a query per card.
+
+    A listing matches a market price when every word of the market price's name appears in
+    the listing's name (so "Rice" matches "Organic Dinorado Rice") and the units agree. The
+    most specific name wins, then a matching category. Market prices with the same name and
+    unit in several locations are averaged.
+
+    The market side is rebuilt whenever the price board cache hands out a new board, i.e.
+    after a price write or its TTL, and listings are matched again as they are shown. Listing
+    edits in this process update their entry through refresh_listing; a listing whose name,
+    category or unit no longer matches its entry (e.g. edited by another process) is
+    re-matched on use.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._board = None                  # price board the references were built from
+        self._references = {}               # (name tokens, unit) -> MarketReference
+        self._by_token = defaultdict(list)  # name token -> reference keys containing it
+        self._listings = {}                 # listing_id -> ((name, category, unit), reference key or None)
+
+    # --- Maintenance ---
+    def rebuild(self):
+        board = price_board.board()
+        groups = defaultdict(list)
+        for row in board:
+            tokens = tuple(sorted(set(tokenize(row.name))))
+            if tokens:
+                groups[(tokens, normalize_unit(row.unit))].append(row)
+        references = {}
+        by_token = defaultdict(list)
+        for key, rows in groups.items():
+            references[key] = MarketReference(
+                name=rows[0].name, category=(rows[0].category or '').lower(), unit=rows[0].unit,
+                price=sum(row.price for row in rows) / len(rows),
+                locations=sorted({row.location for row in rows if row.location}),
+                tokens=frozenset(key[0]))
+            for token in key[0]:
+                by_token[token].append(key)
+        with self._lock:
+            self._board = board
+            self._references = references
+            self._by_token = by_token
+            self._listings = {}  # Matched against the new references as compare() sees them
+
+    def clear(self):
+        with self._lock:
+            self._board = None
+            self._references = {}
+            self._by_token = defaultdict(list)
+            self._listings = {}
+
+    def refresh_listing(self, listing):
+        """Re-matches a listing after it was added or edited."""
+        if self._board is None:
+            return  # Not built yet; the first lookup will load current data
+        signature = (listing.name, listing.category, listing.unit)
+        with self._lock:
+            self._listings[listing.id] = (signature, self._match(self._references, self._by_token, *signature))
+
+    def remove_listing(self, listing_id):
+        with self._lock:
+            self._listings.pop(listing_id, None)
+
+    # --- Querying ---
+    def compare(self, listing):
+        """Returns a MarketComparison for a listing, or None if no official price matches it."""
+        if not g.get('price_comparison_checked'):
+            # One freshness check per request, not per card
+            g.price_comparison_checked = True
+            if self._board is not price_board.board():
+                self.rebuild()
+        signature = (listing.name, listing.category, listing.unit)
+        with self._lock:
+            entry = self._listings.get(listing.id)
+            if entry is None or entry[0] != signature:
+                entry = (signature, self._match(self._references, self._by_token, *signature))
+                self._listings[listing.id] = entry
+            reference = self._references.get(entry[1]) if entry[1] else None
+        if reference is None or not reference.price:
+            return None
+        delta = listing.price - reference.price
+        return MarketComparison(name=reference.name, unit=reference.unit, market_price=reference.price,
+                                delta=delta, percent=delta / reference.price * 100,
+                                locations=reference.locations)
+
+    # --- Internals ---
+    @staticmethod
+    def _match(references, by_token, name, category, unit):
+        tokens = set(tokenize(name))
+        unit = normalize_unit(unit)
+        category = (category or '').lower()
+        best, best_rank = None, None
+        for key in {key for token in tokens for key in by_token.get(token, ())}:
+            reference = references[key]
+            if key[1] != unit or not reference.tokens <= tokens:
+                continue
+            rank = (len(reference.tokens), reference.category == category, key)
+            if best_rank is None or rank > best_rank:
+                best, best_rank = key, rank
+        return best
+
+
+price_comparison = PriceComparisonIndex()
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta, timezone
+
+from extensions import db
+from models import MarketPriceHistory
+from price_rollups import rollup_series
+
+BUCKETS = ('auto', 'raw', 'day', 'week', 'month', 'lttb')
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_range_bound(value, end=False):
+    """
+    Parses a from/to query parameter ('YYYY-MM-DD' or an ISO datetime). A bare date used as
+    the end of a range includes that whole day. Raises ValueError for malformed values.
+    """
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)  # History dates are naive UTC
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+
+def query_history(price_id, start=None, end=None, newest_first=False):
+    """(date, price) rows for a market price in [start, end), oldest first. Served by the (market_price_id, date) index."""
+    query = db.session.query(MarketPriceHistory.date, MarketPriceHistory.price) \
+        .filter(MarketPriceHistory.market_price_id == price_id, MarketPriceHistory.date.isnot(None))
+    if start is not None:
+        query = query.filter(MarketPriceHistory.date >= start)
+    if end is not None:
+        query = query.filter(MarketPriceHistory.date < end)
+    if newest_first:
+        return query.order_by(MarketPriceHistory.date.desc(), MarketPriceHistory.id.desc())
+    return query.order_by(MarketPriceHistory.date.asc(), MarketPriceHistory.id.asc())
+
+
+def lttb(rows, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling of (date, price) rows to `threshold` points.
+    Keeps the first and last points and, from each bucket in between, the point forming the
+    largest triangle with its neighbours, so peaks and dips survive.
+    """
+    if threshold >= len(rows) or threshold < 3:
+        return list(rows)
+    xs = [row[0].timestamp() for row in rows]
+    sampled = [rows[0]]
+    bucket_size = (len(rows) - 2) / (threshold - 2)
+    previous = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        # Average of the next bucket is the third corner of the triangle
+        next_start, next_end = end, min(int((i + 2) * bucket_size) + 1, len(rows))
+        avg_x = sum(xs[next_start:next_end]) / max(next_end - next_start, 1)
+        avg_y = sum(row[1] for row in rows[next_start:next_end]) / max(next_end - next_start, 1)
+        prev_x, prev_y = xs[previous], rows[previous][1]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((prev_x - avg_x) * (rows[j][1] - prev_y) - (prev_x - xs[j]) * (avg_y - prev_y))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(rows[best])
+        previous = best
+    sampled.append(rows[-1])
+    return sampled
+
+
+def build_series(price_id, start, end, bucket, max_points):
+    """
+    Returns (points, bucket used, downsampled flag) for the history API, never more than
+    max_points long. 'auto' returns raw rows when they fit and LTTB-downsampled ones otherwise.
+    """
+    if bucket == 'raw':
+        # Only the newest max_points rows are read, straight off the index
+        rows = query_history(price_id, start, end, newest_first=True).limit(max_points + 1).all()
+        return [_point(row) for row in reversed(rows[:max_points])], bucket, len(rows) > max_points
+
+    if bucket in ('day', 'week', 'month'):
+        # Pre-aggregated: one rollup row per bucket, the most recent ones if the range is too long
+        buckets = rollup_series(price_id, bucket, start, end, limit=max_points + 1)
+        return buckets[-max_points:], bucket, len(buckets) > max_points
+
+    rows = query_history(price_id, start, end).all()
+    if len(rows) > max_points:
+        return [_point(row) for row in lttb(rows, max_points)], 'lttb', True
+    return [_point(row) for row in rows], 'raw' if bucket == 'auto' else bucket, False
+
+
+def _point(row):
+    return {'price': float(row[1]), 'date': row[0].strftime(DATE_FORMAT)}
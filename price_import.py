@@ -0,0 +1,193 @@
+import csv
+import io
+import json
+import time
+from datetime import datetime, timezone
+
+from extensions import db
+from models import MarketPrice, MarketPriceHistory
+from price_rollups import record_history
+
+FORMATS = ('csv', 'json')
+# Errors kept for the report; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+
+def detect_format(filename):
+    """'json' for .json/.jsonl/.ndjson files, 'csv' for everything else."""
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return 'json' if extension in ('json', 'jsonl', 'ndjson') else 'csv'
+
+
+def read_rows(stream, fmt):
+    """
+    Yields (line number, record dict) from a text stream. CSV needs a header row; JSON may be
+    one array of objects or one object per line (JSON Lines). CSV and JSON Lines are read a
+    line at a time, so large feeds are never held in memory; a JSON array is loaded whole.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    first = stream.read(1)
+    while first and first.isspace():
+        first = stream.read(1)
+    if first == '[':
+        records = json.loads(first + stream.read())
+        for number, record in enumerate(records, start=1):
+            yield number, record
+        return
+    for number, line in enumerate(_prepend(first, stream), start=1):
+        if line.strip():
+            try:
+                yield number, json.loads(line)
+            except json.JSONDecodeError as e:
+                # Skipped and reported like any other invalid row (see parse_record)
+                yield number, ValueError(f"invalid JSON: {e.msg} (column {e.colno})")
+
+
+def _prepend(first, stream):
+    lines = iter(stream)
+    line = next(lines, '')
+    if first or line:
+        yield first + line
+    yield from lines
+
+
+def parse_record(record):
+    """
+    Validates one feed record and returns (name, category, price, unit, location, date).
+    category and unit may be blank for prices that already exist. Raises ValueError, also
+    for a line read_rows could not decode (passed in as the ValueError to raise).
+    """
+    if isinstance(record, ValueError):
+        raise record
+    if not isinstance(record, dict):
+        raise ValueError("expected an object with name, price, ...")
+    values = {key.strip().lower(): value for key, value in record.items() if key}
+    name = str(values.get('name') or '').strip()
+    if not name:
+        raise ValueError("name is required")
+    try:
+        price = float(values.get('price'))
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid price {values.get('price')!r}") from None
+    if price < 0:
+        raise ValueError("price cannot be negative")
+    date = values.get('date') or values.get('updated_at')
+    if date:
+        try:
+            date = datetime.fromisoformat(str(date).strip())
+        except ValueError:
+            raise ValueError(f"invalid date {date!r}") from None
+        if date.tzinfo is not None:
+            date = date.astimezone(timezone.utc).replace(tzinfo=None)  # Stored as naive UTC
+    return (name, str(values.get('category') or '').strip(), price,
+            str(values.get('unit') or '').strip(), str(values.get('location') or '').strip() or None,
+            date or None)
+
+
+def _key(name, location):
+    return name.lower(), (location or '').lower()
+
+
+def import_prices(records, batch_size=1000, commit=True):
+    """
+    Upserts market prices by (name, location) from (line number, record) pairs and appends
+    the price each update replaces to the history, as edit_price does. Rows dated before a
+    price's current one only add a history entry. History rows go in with one executemany
+    per batch, together with their rollups, and existing prices are updated in one statement
+    at the end, all in a single transaction. Returns a summary dict with rows/second;
+    'created' and 'updated' count distinct prices, so a price created by the feed and then
+    changed by later rows counts in both.
+    """
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    summary = {'rows': 0, 'created': 0, 'updated': 0, 'history': 0, 'skipped': 0, 'errors': []}
+
+    # Commodities number in the hundreds, so the current board fits in memory
+    current = {}  # key -> [id, price, updated_at, category, unit]
+    for price_id, name, location, price, updated_at, category, unit in db.session.query(
+            MarketPrice.id, MarketPrice.name, MarketPrice.location, MarketPrice.price,
+            MarketPrice.updated_at, MarketPrice.category, MarketPrice.unit):
+        current[_key(name, location)] = [price_id, price, updated_at, category, unit]
+    changed = set()  # keys of prices to update at the end
+    history = []
+
+    try:
+        for number, record in records:
+            try:
+                name, category, price, unit, location, date = parse_record(record)
+            except ValueError as e:
+                _skip(summary, number, e)
+                continue
+            date = date or now
+            key = _key(name, location)
+            state = current.get(key)
+
+            if state is None:
+                if not category or not unit:
+                    _skip(summary, number, "category and unit are required for a new price")
+                    continue
+                new_price = MarketPrice(name=name, category=category, price=price, unit=unit,
+                                        location=location, updated_at=date)
+                db.session.add(new_price)
+                db.session.flush()  # Later rows for the same commodity need its id
+                current[key] = [new_price.id, price, date, category, unit]
+                summary['created'] += 1
+            elif state[2] is not None and date < state[2]:
+                # Backfill: older than what the board shows, so it only belongs in the history
+                history.append({'market_price_id': state[0], 'price': price, 'date': date})
+            else:
+                history.append({'market_price_id': state[0], 'price': state[1], 'date': state[2]})
+                state[1], state[2] = price, date
+                state[3], state[4] = category or state[3], unit or state[4]
+                if key not in changed:
+                    changed.add(key)
+                    summary['updated'] += 1  # Also prices created earlier in this feed
+
+            summary['rows'] += 1
+            if len(history) >= batch_size:
+                _insert_history(history, summary)
+
+        _insert_history(history, summary)
+        if changed:
+            # ORM bulk UPDATE by primary key: one executemany for every changed price
+            db.session.execute(db.update(MarketPrice), [
+                {'id': state[0], 'price': state[1], 'updated_at': state[2], 'category': state[3], 'unit': state[4]}
+                for state in (current[key] for key in changed)
+            ])
+        if commit:
+            db.session.commit()
+        else:
+            db.session.rollback()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    summary['seconds'] = time.perf_counter() - started
+    summary['rows_per_second'] = summary['rows'] / summary['seconds'] if summary['seconds'] else 0.0
+    return summary
+
+
+def _skip(summary, number, error):
+    summary['skipped'] += 1
+    if len(summary['errors']) < MAX_REPORTED_ERRORS:
+        summary['errors'].append(f"Row {number}: {error}")
+
+
+def _insert_history(history, summary):
+    if history:
+        db.session.execute(db.insert(MarketPriceHistory), history)
+        record_history([(row['market_price_id'], row['price'], row['date']) for row in history])
+        summary['history'] += len(history)
+        history.clear()
+
+
+def import_file(stream, fmt, batch_size=1000, commit=True):
+    """import_prices for a binary or text file object (e.g. an upload), decoded as UTF-8."""
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    return import_prices(read_rows(stream, fmt), batch_size=batch_size, commit=commit)
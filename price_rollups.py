@@ -0,0 +1,196 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import MarketPrice, MarketPriceHistory, MarketPriceRollup
+
+PERIODS = ('day', 'week', 'month')
+AGGREGATE_COLUMNS = ('min_price', 'max_price', 'sum_price', 'count',
+                     'first_price', 'first_date', 'last_price', 'last_date')
+
+
+def period_start(period, moment):
+    """First day of the day / week (Monday) / month containing `moment`."""
+    day = moment.date() if isinstance(moment, datetime) else moment
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def aggregate_points(points):
+    """Folds (market_price_id, price, date) points into {(market_price_id, period, period_start): aggregate}."""
+    aggregates = {}
+    for price_id, price, moment in points:
+        if moment is None:
+            continue  # Undated history can't be placed in a period (charts skip it too)
+        point = {'min_price': price, 'max_price': price, 'sum_price': price, 'count': 1,
+                 'first_price': price, 'first_date': moment, 'last_price': price, 'last_date': moment}
+        for period in PERIODS:
+            key = (price_id, period, period_start(period, moment))
+            if key in aggregates:
+                _merge(aggregates[key], point)
+            else:
+                aggregates[key] = dict(point)
+    return aggregates
+
+
+def _merge(target, other):
+    target['min_price'] = min(target['min_price'], other['min_price'])
+    target['max_price'] = max(target['max_price'], other['max_price'])
+    target['sum_price'] += other['sum_price']
+    target['count'] += other['count']
+    if other['first_date'] < target['first_date']:
+        target['first_price'], target['first_date'] = other['first_price'], other['first_date']
+    # On equal dates the point added later wins, as it does for the current price
+    if other['last_date'] >= target['last_date']:
+        target['last_price'], target['last_date'] = other['last_price'], other['last_date']
+
+
+def record_history(points):
+    """
+    Folds newly appended history points (market_price_id, price, date) into the rollups,
+    inside the caller's transaction. Call it wherever MarketPriceHistory rows are added.
+    Returns the number of rollup rows touched.
+    """
+    aggregates = aggregate_points(points)
+    if not aggregates:
+        return 0
+    for attempt in range(2):
+        try:
+            with db.session.begin_nested():
+                _apply(aggregates)
+            return len(aggregates)
+        except IntegrityError:
+            # A concurrent writer inserted one of our periods first; merge into its row instead
+            if attempt:
+                raise
+
+
+def _apply(aggregates):
+    price_ids = {key[0] for key in aggregates}
+    starts = {key[2] for key in aggregates}
+    # Row locks (PostgreSQL) keep concurrent writers from losing each other's updates
+    existing = db.session.execute(
+        db.select(MarketPriceRollup.id, MarketPriceRollup.market_price_id, MarketPriceRollup.period,
+                  MarketPriceRollup.period_start, *(getattr(MarketPriceRollup, column) for column in AGGREGATE_COLUMNS))
+        .where(MarketPriceRollup.market_price_id.in_(price_ids), MarketPriceRollup.period_start.in_(starts))
+        .with_for_update()
+    ).all()
+
+    updates = []
+    pending = dict(aggregates)
+    for row in existing:
+        aggregate = pending.pop((row.market_price_id, row.period, row.period_start), None)
+        if aggregate is None:
+            continue  # Another period that happens to start on one of our dates
+        merged = {column: getattr(row, column) for column in AGGREGATE_COLUMNS}
+        _merge(merged, aggregate)
+        updates.append(dict(merged, id=row.id))
+
+    if updates:
+        db.session.execute(db.update(MarketPriceRollup), updates)
+    if pending:
+        db.session.execute(db.insert(MarketPriceRollup), [
+            dict(aggregate, market_price_id=price_id, period=period, period_start=start)
+            for (price_id, period, start), aggregate in pending.items()
+        ])
+
+
+def rebuild_rollups(price_id=None, batch_size=1000):
+    """
+    Recomputes the rollups from MarketPriceHistory, for one market price or all of them, and
+    commits. History is streamed in (market_price_id, date) order and aggregated one price at
+    a time. Returns (history rows read, rollup rows written).
+    """
+    delete = db.delete(MarketPriceRollup)
+    history = db.select(MarketPriceHistory.market_price_id, MarketPriceHistory.price, MarketPriceHistory.date) \
+        .where(MarketPriceHistory.date.isnot(None)) \
+        .order_by(MarketPriceHistory.market_price_id, MarketPriceHistory.date, MarketPriceHistory.id)
+    if price_id is not None:
+        delete = delete.where(MarketPriceRollup.market_price_id == price_id)
+        history = history.where(MarketPriceHistory.market_price_id == price_id)
+
+    read = written = 0
+    try:
+        db.session.execute(delete)
+        points, batch = [], []
+        for point in db.session.execute(history.execution_options(yield_per=batch_size)):
+            if points and point[0] != points[-1][0]:
+                batch.extend(_rollup_rows(points))
+                points = []
+            points.append(tuple(point))
+            read += 1
+            if len(batch) >= batch_size:
+                written += _insert_rollups(batch)
+        batch.extend(_rollup_rows(points))
+        written += _insert_rollups(batch)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return read, written
+
+
+def _rollup_rows(points):
+    return [dict(aggregate, market_price_id=price_id, period=period, period_start=start)
+            for (price_id, period, start), aggregate in aggregate_points(points).items()]
+
+
+def _insert_rollups(batch):
+    count = len(batch)
+    if batch:
+        db.session.execute(db.insert(MarketPriceRollup), batch)
+        batch.clear()
+    return count
+
+
+def delete_rollups(price_id):
+    """Removes a market price's rollups (with its history, before deleting the price)."""
+    MarketPriceRollup.query.filter_by(market_price_id=price_id).delete()
+
+
+def rollup_series(price_id, period, start=None, end=None, limit=None):
+    """
+    OHLC-style buckets for a market price read straight from the rollups, oldest first: one
+    row per period, however many history rows it covers. Periods overlapping [start, end)
+    are included whole. With a limit, only the most recent `limit` periods are returned.
+    """
+    query = MarketPriceRollup.query.filter_by(market_price_id=price_id, period=period)
+    if start is not None:
+        query = query.filter(MarketPriceRollup.period_start >= period_start(period, start))
+    if end is not None:
+        query = query.filter(MarketPriceRollup.period_start <= (end - timedelta(microseconds=1)).date())
+    query = query.order_by(MarketPriceRollup.period_start.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return [{'date': rollup.period_start.isoformat(), 'open': rollup.first_price,
+             'high': rollup.max_price, 'low': rollup.min_price, 'close': rollup.last_price,
+             'avg': rollup.avg_price, 'count': rollup.count, 'price': rollup.last_price}
+            for rollup in reversed(query.all())]
+
+
+def last_week_prices(now=None):
+    """
+    {market_price_id: price in effect at the end of last week} for the whole board, from
+    one weekly rollup row per price. Prices not changed this week are still at that value.
+    """
+    this_week = period_start('week', now or datetime.utcnow())
+    latest = db.select(MarketPriceRollup.market_price_id,
+                       db.func.max(MarketPriceRollup.period_start).label('period_start')) \
+        .where(MarketPriceRollup.period == 'week', MarketPriceRollup.period_start < this_week) \
+        .group_by(MarketPriceRollup.market_price_id).subquery()
+    rows = db.session.query(MarketPrice.id, MarketPrice.price, MarketPrice.updated_at, MarketPriceRollup.last_price) \
+        .outerjoin(latest, latest.c.market_price_id == MarketPrice.id) \
+        .outerjoin(MarketPriceRollup, db.and_(MarketPriceRollup.market_price_id == MarketPrice.id,
+                                              MarketPriceRollup.period == 'week',
+                                              MarketPriceRollup.period_start == latest.c.period_start)).all()
+    prices = {}
+    for price_id, price, updated_at, last_price in rows:
+        if updated_at is not None and updated_at.date() < this_week:
+            prices[price_id] = price  # Unchanged since before this week
+        elif last_price is not None:
+            prices[price_id] = last_price  # The last price set before this week
+    return prices
@@ -0,0 +1,148 @@
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from extensions import db
+from models import CartItem, ProductListing, clamped_increment
+
+
+def reserve(cart_item, quantity):
+    """
+    Sets the stock held for a cart item to `quantity` and renews its expiry.
+    Holding more is a guarded atomic UPDATE that only succeeds if enough unreserved stock
+    remains; holding less gives the difference back. Returns False if the stock isn't there.
+    The caller commits.
+    """
+    if cart_item.id is not None:
+        # Lock our item row so a concurrent sweep can't release the hold under us
+        db.session.refresh(cart_item, with_for_update=True)
+    delta = quantity - (cart_item.reserved_quantity or 0.0)
+    if delta > 0:
+        result = db.session.execute(
+            db.update(ProductListing)
+            .where(ProductListing.id == cart_item.product_id,
+                   ProductListing.quantity_available - ProductListing.quantity_reserved >= delta)
+            .values(quantity_reserved=ProductListing.quantity_reserved + delta)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            return False
+    elif delta < 0:
+        _adjust_reserved(cart_item.product_id, delta)
+
+    ttl = current_app.config.get('CART_RESERVATION_TTL', 900)
+    cart_item.reserved_quantity = quantity
+    cart_item.reserved_until = datetime.utcnow() + timedelta(seconds=ttl)
+    return True
+
+
+def release(cart_item):
+    """Gives a cart item's held stock back (e.g. before removing it from the cart). The caller commits."""
+    if cart_item.reserved_quantity:
+        _adjust_reserved(cart_item.product_id, -cart_item.reserved_quantity)
+    cart_item.reserved_quantity = 0.0
+    cart_item.reserved_until = None
+
+
+def release_expired(now=None, batch_size=500):
+    """
+    Releases every expired hold in bulk: per batch, one UPDATE clears the cart items and one
+    UPDATE gives the summed quantities back to their listings. Locked items are skipped (their
+    owner is renewing them). Commits each batch and returns the number of holds released.
+    """
+    now = now or datetime.utcnow()
+    released = 0
+    while True:
+        rows = db.session.query(CartItem.id, CartItem.product_id, CartItem.reserved_quantity) \
+            .filter(CartItem.reserved_until < now, CartItem.reserved_quantity > 0) \
+            .order_by(CartItem.id).limit(batch_size) \
+            .with_for_update(skip_locked=True).all()
+        if not rows:
+            break
+
+        held = defaultdict(float)
+        for row in rows:
+            if row.product_id is not None:
+                held[row.product_id] += row.reserved_quantity
+        db.session.execute(
+            db.update(CartItem).where(CartItem.id.in_([row.id for row in rows]))
+            .values(reserved_quantity=0.0, reserved_until=None)
+            .execution_options(synchronize_session=False)
+        )
+        if held:
+            returned = db.case(dict(held), value=ProductListing.id)
+            db.session.execute(
+                db.update(ProductListing).where(ProductListing.id.in_(sorted(held)))
+                # A sweep isn't an edit of the listing, so keep updated_at as is
+                .values(quantity_reserved=clamped_increment(ProductListing.quantity_reserved, -returned),
+                        updated_at=ProductListing.updated_at)
+                .execution_options(synchronize_session=False)
+            )
+        db.session.commit()
+        released += len(rows)
+        if len(rows) < batch_size:
+            break
+    return released
+
+
+def _adjust_reserved(product_id, delta):
+    if product_id is None or not delta:
+        return
+    db.session.execute(
+        db.update(ProductListing).where(ProductListing.id == product_id)
+        .values(quantity_reserved=clamped_increment(ProductListing.quantity_reserved, delta),
+                updated_at=ProductListing.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+
+
+class ReservationSweeper:
+    """
+    Background thread that periodically calls release_expired. Started on the first request
+    of each worker process (so CLI commands such as migrations never start it); running one
+    per worker is safe because sweeps skip rows another sweep has locked.
+    Disabled when RESERVATION_SWEEP_INTERVAL is 0; 'flask sweep-reservations' can run from cron instead.
+    """
+
+    def __init__(self, app=None):
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('RESERVATION_SWEEP_INTERVAL'):
+            return
+
+        @app.before_request
+        def _start_reservation_sweeper():
+            if self._thread is None:
+                self.start(app)
+
+    def start(self, app):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='reservation-sweeper', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, app):
+        interval = app.config.get('RESERVATION_SWEEP_INTERVAL', 60)
+        while not self._stop.wait(interval):
+            with app.app_context():
+                try:
+                    release_expired()
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f"Error releasing expired cart reservations: {e}")
+                finally:
+                    db.session.remove()
+
+
+reservation_sweeper = ReservationSweeper()
@@ -1,17 +1,39 @@
 import os # Import os module
+import sys
+import re
+import mimetypes
+import base64
+import json
+import time
+import uuid
 from flask import (Blueprint, render_template, request, redirect, url_for,
-                   flash, jsonify, abort, current_app, send_from_directory, session) # Added current_app, send_from_directory
+                   flash, jsonify, abort, current_app, session, Response) # Added current_app
+from markupsafe import Markup
 from flask_login import login_user, logout_user, login_required, current_user # type: ignore
-from werkzeug.security import generate_password_hash
-from werkzeug.utils import secure_filename # Import secure_filename
-from urllib.parse import urlparse, urljoin # Import from standard library
-from datetime import datetime
+from werkzeug.security import generate_password_hash, safe_join
+from werkzeug.http import is_resource_modified
+from werkzeug.utils import send_file as werkzeug_send_file
+from urllib.parse import urlparse, urljoin, quote # Import from standard library
+from datetime import datetime, timezone
 # Correct import:
 from models import (db, User, MarketPrice, Crop, Livestock, MarketPriceHistory,
-                    ProductListing, FarmerNote, Cart, CartItem, Order, OrderItem, Conversation, Message) # Added Cart, CartItem
+                    ProductListing, FarmerNote, Cart, CartItem, Order, OrderItem, Conversation, Message,
+                    OrderIdempotencyKey) # Added Cart, CartItem
+from search import search_index, rank_listings
+from cache import category_facets, upload_stats, price_board, user_cache
+from price_comparison import price_comparison
+from extensions import broker
+from broker import conversation_channel, user_channel
+import reservations
+from images import store_image, rendition_filename, image_url, discard_image
+from jobs import queue_renditions, request_renditions
+from price_history import BUCKETS as PRICE_HISTORY_BUCKETS, build_series as build_price_series, parse_range_bound
+from price_rollups import record_history as record_price_history, delete_rollups as delete_price_rollups
+from price_import import FORMATS as PRICE_IMPORT_FORMATS, detect_format as detect_price_format, import_file as import_price_file
 from functools import wraps
 import decimal
 from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 
 main_bp = Blueprint('main', __name__)
 
@@ -23,29 +45,16 @@ def allowed_file(filename):
 
 # --- Helper Function to Save File ---
 def save_product_image(file):
-    """Saves the uploaded product image and returns the secure filename."""
+    """Saves the uploaded product image under its content hash and returns the stored filename."""
     if file and allowed_file(file.filename):
-        # Generate a secure filename (prevents path traversal, etc.)
-        filename = secure_filename(file.filename)
-        # Create a unique filename (e.g., using UUID or timestamp) to avoid collisions (Optional but recommended)
-        # import uuid
-        # unique_filename = str(uuid.uuid4()) + "_" + filename
-        # For simplicity, we'll use secure_filename directly for now, but collisions are possible.
-        unique_filename = filename # Consider making this unique later
-
-        # Get the configured upload path
-        upload_folder = current_app.config['UPLOAD_FOLDER']
-        # Ensure the upload folder exists (create if it doesn't)
-        os.makedirs(upload_folder, exist_ok=True)
-
-        filepath = os.path.join(upload_folder, unique_filename)
         try:
-            file.save(filepath)
-            return unique_filename # Return the filename saved
+            # Content-addressed: identical uploads share one file and names never collide
+            stored_filename = store_image(file)
         except Exception as e:
-            print(f"Error saving file {unique_filename}: {e}")
+            print(f"Error saving file {file.filename}: {e}")
             flash(f"Error saving image file: {e}", "danger")
             return None
+        return stored_filename # Thumbnails are queued by queue_renditions with the listing
     elif file:
         # File was uploaded but extension not allowed
         flash("Invalid image file type. Allowed types are: {}.".format(
@@ -53,23 +62,109 @@ def save_product_image(file):
         return None
     return None # No file uploaded or error occurred
 
+# --- Catalog Cache Maintenance ---
+def listing_changed(listing):
+    """Brings per-process catalog caches up to date after a listing was added or edited (call after commit)."""
+    search_index.refresh_listing(listing)
+    category_facets.invalidate()
+    price_comparison.refresh_listing(listing)
+
+def listing_removed(listing_id):
+    """Drops a deleted listing from per-process catalog caches (call after commit)."""
+    search_index.remove_listing(listing_id)
+    category_facets.invalidate()
+    price_comparison.remove_listing(listing_id)
+
+# --- Catalog Pagination Helpers ---
+def encode_listing_cursor(listing):
+    """Encodes the (created_at, id) keyset position of a listing as an opaque URL-safe cursor."""
+    raw = f"{listing.created_at.isoformat()}|{listing.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_listing_cursor(cursor):
+    """Decodes a cursor from encode_listing_cursor. Returns (created_at, id) or None if invalid."""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_str, id_str = base64.urlsafe_b64decode(padded.encode()).decode().split('|', 1)
+        return datetime.fromisoformat(created_str), int(id_str)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+# Columns rendered by _product_cards.html (plus created_at for the keyset cursor).
+# Loading only these keeps descriptions and other unused columns out of catalog pages.
+CATALOG_CARD_COLUMNS = (ProductListing.id, ProductListing.name, ProductListing.category, ProductListing.image_filename,
+                        ProductListing.image_ready, ProductListing.price, ProductListing.unit, ProductListing.quantity_available,
+                        ProductListing.quantity_reserved, ProductListing.user_id, ProductListing.created_at)
+
+def build_catalog_query(category_filter):
+    """Base query for active listings shown in the catalog, with the category filter applied."""
+    query = ProductListing.query.filter_by(status='active').join(User, ProductListing.user_id == User.id)
+    if category_filter:
+        query = query.filter(ProductListing.category.ilike(f"%{category_filter}%"))
+    return query
+
+def fetch_catalog_page(query, cursor=None, page_size=None):
+    """
+    Returns (listings, next_cursor) for one keyset page of the catalog, newest first.
+    Seeks past the cursor position instead of using OFFSET, so deep pages cost the same as the first.
+    """
+    page_size = page_size or current_app.config.get('PRODUCTS_PER_PAGE', 24)
+    position = decode_listing_cursor(cursor)
+    if position:
+        created_at, listing_id = position
+        query = query.filter(db.or_(
+            ProductListing.created_at < created_at,
+            db.and_(ProductListing.created_at == created_at, ProductListing.id < listing_id)
+        ))
+    # Fetch one extra row to know whether another page exists.
+    # The owner comes from the existing User join, so cards don't trigger a query per listing.
+    rows = query.options(
+        db.load_only(*CATALOG_CARD_COLUMNS),
+        db.contains_eager(ProductListing.farmer).load_only(User.id, User.username)
+    ).order_by(ProductListing.created_at.desc(), ProductListing.id.desc()).limit(page_size + 1).all()
+    listings = rows[:page_size]
+    next_cursor = encode_listing_cursor(listings[-1]) if len(rows) > page_size else None
+    return listings, next_cursor
+
+def fetch_search_page(query, search_query, cursor=None, page_size=None):
+    """
+    Returns (listings, next_cursor) for one page of search results, most relevant first.
+    The cursor is the offset into the ranked result list (bounded by SEARCH_MAX_RESULTS).
+    """
+    page_size = page_size or current_app.config.get('PRODUCTS_PER_PAGE', 24)
+    offset = int(cursor) if cursor and cursor.isdigit() else 0
+    ranked_ids = rank_listings(query, search_query)
+    page_ids = ranked_ids[offset:offset + page_size]
+    if not page_ids:
+        return [], None
+    page_rows = ProductListing.query.options(
+        db.load_only(*CATALOG_CARD_COLUMNS),
+        db.joinedload(ProductListing.farmer).load_only(User.id, User.username)
+    ).filter(ProductListing.id.in_(page_ids)).all()
+    listings_by_id = {listing.id: listing for listing in page_rows}
+    listings = [listings_by_id[listing_id] for listing_id in page_ids if listing_id in listings_by_id]
+    next_cursor = str(offset + page_size) if len(ranked_ids) > offset + page_size else None
+    return listings, next_cursor
+
+def fetch_browse_page(search_query, category_filter, cursor=None):
+    """One catalog page: relevance-ranked when searching, newest first otherwise."""
+    query = build_catalog_query(category_filter)
+    if search_query:
+        return fetch_search_page(query, search_query, cursor)
+    return fetch_catalog_page(query, cursor)
+
 @main_bp.route("/products", methods=["GET"])
 def browse_products():
     search_query = request.args.get("search", "").strip()
     category_filter = request.args.get("category", "").strip()
-    # Changed join from 'users' to 'user' to match the renamed table (already done)
-    query = ProductListing.query.filter_by(status='active').join(User, ProductListing.user_id == User.id)
+    cursor = request.args.get("cursor", "").strip() or None
 
-    if search_query:
-        search_term = f"%{search_query}%"
-        query = query.filter(db.or_(ProductListing.name.ilike(search_term), ProductListing.description.ilike(search_term)))
-    if category_filter:
-        query = query.filter(ProductListing.category.ilike(f"%{category_filter}%"))
+    # (category, active listing count) pairs, served from the per-process facet cache
+    category_facet_list = category_facets.get()
 
-    categories = db.session.query(ProductListing.category).filter(ProductListing.category.isnot(None)).distinct().order_by(ProductListing.category).all()
-    category_list = [cat[0] for cat in categories]
-
-    products = query.order_by(ProductListing.created_at.desc()).all()
+    products, next_cursor = fetch_browse_page(search_query, category_filter, cursor)
 
     # Get cart item count for display in navbar/header (optional)
     cart_item_count = 0
@@ -80,11 +175,23 @@ def browse_products():
 
     return render_template("products_browse.html",
                            products=products,
+                           next_cursor=next_cursor,
                            search=search_query,
                            selected_category=category_filter,
-                           categories=category_list,
+                           category_facets=category_facet_list,
                            cart_item_count=cart_item_count) # Pass count to template
 
+@main_bp.route("/products/page", methods=["GET"])
+def browse_products_page():
+    """Returns the next page of product cards as an HTML fragment for infinite scroll."""
+    search_query = request.args.get("search", "").strip()
+    category_filter = request.args.get("category", "").strip()
+    cursor = request.args.get("cursor", "").strip() or None
+
+    products, next_cursor = fetch_browse_page(search_query, category_filter, cursor)
+    html = render_template("_product_cards.html", products=products)
+    return jsonify({'html': html, 'next_cursor': next_cursor})
+
 
 # --- Core Routes ---
 # (index, market_prices, browse_products remain unchanged)
@@ -96,12 +203,9 @@ def index():
 def market_prices():
     current_datetime_str = datetime.now().strftime("%A, %B %d, %Y %I:%M:%S %p")
     search_query = request.args.get("search", "").strip()
-    query = MarketPrice.query
-    if search_query:
-        search_term = f"%{search_query}%"
-        query = query.filter(db.or_(MarketPrice.name.ilike(search_term), MarketPrice.category.ilike(search_term)))
-    official_prices = query.order_by(MarketPrice.category, MarketPrice.name).all()
-    return render_template("market_prices.html", current_datetime=current_datetime_str, market_prices=official_prices, search=search_query)
+    # The table rows come from the price board cache; only the page around them is rendered per request
+    price_rows = price_board.fragment(search_query, lambda rows: render_template("_market_price_rows.html", market_prices=rows))
+    return render_template("market_prices.html", current_datetime=current_datetime_str, price_rows=Markup(price_rows), search=search_query)
 
 # --- Authentication Routes ---
 # (register, login, logout )
@@ -146,6 +250,7 @@ def register():
             user.set_password(password)
             db.session.add(user)
             db.session.commit()
+            user_cache.invalidate(user.id) # In case a deleted user's id was reused
             flash('Registration successful! Please log in.', 'success')
             return redirect(url_for('main.login'))
         except Exception as e:
@@ -287,11 +392,13 @@ def farmer_add_listing():
                 name=name, description=description, category=category, price=price, unit=unit,
                 quantity_available=quantity,
                 image_filename=saved_filename, # Save the filename to the DB
+                image_ready=queue_renditions(saved_filename), # False until the image worker made the thumbnails
                 status='active',
                 user_id=current_user.id
             )
             db.session.add(new_listing)
             db.session.commit()
+            listing_changed(new_listing)
             flash('Product listing added and is now active!', 'success')
             return redirect(url_for('main.farmer_manage_listings'))
         except Exception as e:
@@ -316,20 +423,12 @@ def farmer_edit_listing(listing_id):
             # User uploaded a new file
             new_filename = save_product_image(image_file)
             if new_filename:
-                # TODO: Delete old image file if it exists and is different (optional cleanup)
-                # if saved_filename and saved_filename != new_filename:
-                #    old_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], saved_filename)
-                #    if os.path.exists(old_filepath): os.remove(old_filepath)
-                saved_filename = new_filename # Update filename to the new one
+                saved_filename = new_filename # Update filename to the new one (old file is discarded after commit)
             else:
                 # Error saving new file, return form
                 return render_template('farmer/edit_listing.html', listing=listing, form_data=request.form)
         elif remove_image_flag:
-             # TODO: Delete old image file if it exists (optional cleanup)
-             # if saved_filename:
-             #    old_filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], saved_filename)
-             #    if os.path.exists(old_filepath): os.remove(old_filepath)
-             saved_filename = None # Remove filename from DB
+             saved_filename = None # Remove filename from DB (old file is discarded after commit)
         # --- End File Upload Handling ---
 
         try:
@@ -354,7 +453,10 @@ def farmer_edit_listing(listing_id):
                 return render_template('farmer/edit_listing.html', listing=listing, form_data=request.form)
 
             # Update listing fields
+            previous_filename = listing.image_filename
             listing.name = name; listing.description = description; listing.category = category; listing.price = price; listing.unit = unit; listing.quantity_available = quantity;
+            if saved_filename != previous_filename:
+                listing.image_ready = queue_renditions(saved_filename) # Placeholder until thumbnails exist
             listing.image_filename = saved_filename # Update filename
             farmer_allowed_statuses = ['active', 'inactive', 'sold_out']
             if new_status in farmer_allowed_statuses:
@@ -362,6 +464,9 @@ def farmer_edit_listing(listing_id):
             listing.updated_at = datetime.utcnow()
 
             db.session.commit()
+            listing_changed(listing)
+            if previous_filename != saved_filename:
+                discard_image(previous_filename) # Kept if another listing uses the same image
             flash('Product listing updated successfully!', 'success')
             return redirect(url_for('main.farmer_manage_listings'))
         except Exception as e:
@@ -392,16 +497,10 @@ def farmer_delete_listing(listing_id):
     try:
         db.session.delete(listing)
         db.session.commit()
+        listing_removed(listing_id)
 
-        # ✅ Delete the image file (after DB commit)
-        if image_to_delete:
-            try:
-                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], image_to_delete)
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                    print(f"Deleted image file: {filepath}")
-            except Exception as img_del_e:
-                print(f"Error deleting image file {image_to_delete}: {img_del_e}")
+        # ✅ Delete the image file and its thumbnails (after DB commit, unless another listing shares it)
+        discard_image(image_to_delete)
 
         flash('✅ Product listing deleted successfully!', 'success')
 
@@ -414,18 +513,96 @@ def farmer_delete_listing(listing_id):
 
 
 # --- Route to Serve Uploaded Images ---
+# Content-addressed uploads (see images.store_image) and their renditions never change
+HASHED_UPLOAD_RE = re.compile(r'^(?:derived/)?[0-9a-f]{64}(?:-\w+)?\.\w+$')
+
+def upload_path(relative_path):
+    """Absolute path of a file in UPLOAD_FOLDER, or None if it would escape the folder."""
+    upload_folder = current_app.config.get('UPLOAD_FOLDER')
+    return safe_join(upload_folder, relative_path) if upload_folder else None
+
+def send_upload(relative_path, revalidate=False):
+    """
+    Sends a file from UPLOAD_FOLDER with validators and a caching policy. Conditional requests
+    are answered with 304 from the stat cache alone, without touching the filesystem.
+    Content-hashed files are cached as immutable; anything else (older uploads, or an original
+    standing in for a rendition that isn't ready) has to be revalidated.
+    """
+    path = upload_path(relative_path)
+    info = upload_stats.get(path) if path else None
+    if info is None:
+        abort(404)
+    size, mtime = info
+    immutable = not revalidate and HASHED_UPLOAD_RE.match(relative_path) is not None
+    # A hashed name already identifies the content; otherwise derive a validator from the stat
+    etag = os.path.basename(relative_path).rsplit('.', 1)[0] if immutable else f"{int(mtime * 1000):x}-{size:x}"
+    last_modified = datetime.fromtimestamp(int(mtime), timezone.utc)
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+    else:
+        response = upload_file_response(path, relative_path, etag, last_modified)
+
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.no_cache = None # send_file defaults to no-cache
+        response.cache_control.max_age = current_app.config.get('UPLOAD_CACHE_MAX_AGE', 31536000)
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = 0
+        response.cache_control.no_cache = True
+    return response
+
+UPLOAD_SERVE_MODES = ('file_wrapper', 'python', 'x-sendfile', 'x-accel-redirect')
+
+def upload_file_response(path, relative_path, etag, last_modified):
+    """
+    Builds the 200/206 response for an upload according to UPLOAD_SERVE_MODE:
+    'file_wrapper' hands the open file to the WSGI server's wsgi.file_wrapper (sendfile under
+    e.g. gunicorn), 'python' streams it through the worker in chunks, and 'x-sendfile' /
+    'x-accel-redirect' return no body and let the front proxy (Apache/lighttpd, nginx) send it.
+    """
+    mode = current_app.config.get('UPLOAD_SERVE_MODE', 'file_wrapper')
+    if mode == 'x-accel-redirect':
+        # nginx serves UPLOAD_ACCEL_PREFIX from an 'internal' location aliased to UPLOAD_FOLDER,
+        # keeping our ETag and Cache-Control headers
+        response = current_app.response_class(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = current_app.config.get('UPLOAD_ACCEL_PREFIX', '/protected-uploads/').rstrip('/') + '/' + quote(relative_path)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+    environ = request.environ
+    if mode == 'python':
+        # Without a server file_wrapper, werkzeug falls back to reading the file in Python
+        environ = {key: value for key, value in environ.items() if key != 'wsgi.file_wrapper'}
+    # send_file also handles Range and If-Range requests
+    return werkzeug_send_file(path, environ, etag=etag, last_modified=last_modified, conditional=True,
+                              use_x_sendfile=(mode == 'x-sendfile'), response_class=current_app.response_class)
+
 @main_bp.route('/uploads/<path:filename>')
 def uploaded_file(filename):
     """Serves files from the UPLOAD_FOLDER."""
-    # Use send_from_directory for security
-    # It prevents accessing files outside the specified directory
-    upload_folder = current_app.config.get('UPLOAD_FOLDER')
-    if not upload_folder:
-        abort(404) # Or log an error - upload folder not configured
-    # Check if file exists to provide a cleaner 404 if needed
-    if not os.path.exists(os.path.join(upload_folder, filename)):
-         abort(404)
-    return send_from_directory(upload_folder, filename)
+    return send_upload(filename)
+
+@main_bp.route('/uploads/renditions/<rendition>/<path:filename>')
+def image_rendition(rendition, filename):
+    """Serves a resized WebP rendition of an uploaded image, falling back to the original until it exists."""
+    if rendition not in current_app.config.get('IMAGE_RENDITIONS', {}):
+        abort(404)
+    original_path = upload_path(filename)
+    if not original_path or upload_stats.get(original_path) is None:
+        abort(404)
+    derived = rendition_filename(filename, rendition)
+    derived_path = upload_path(derived)
+    # Uploaded before renditions existed (or they were deleted): queue them and serve the original meanwhile
+    if upload_stats.get(derived_path) is None and request_renditions(filename):
+        upload_stats.invalidate(derived_path) # Inline processing may have just written it
+    if upload_stats.get(derived_path) is not None:
+        return send_upload(derived)
+    # Not ready yet (or no Pillow): the original, revalidated so the rendition replaces it later
+    return send_upload(filename, revalidate=True)
 
 
 # --- Admin Routes ---
@@ -473,6 +650,7 @@ def admin_update_listing_status(listing_id):
     try:
         listing.status = new_status; listing.updated_at = datetime.utcnow()
         db.session.commit()
+        listing_changed(listing)
         flash(f'Listing "{listing.name}" status updated to {new_status}.', 'success')
     except Exception as e:
         db.session.rollback(); flash(f'Error updating listing status: {str(e)}', 'danger'); print(f"Admin Update Status Error: {e}")
@@ -486,8 +664,7 @@ def admin_update_listing_status(listing_id):
 @login_required
 @admin_required
 def admin_manage_prices():
-    prices = MarketPrice.query.order_by(MarketPrice.category, MarketPrice.name).all()
-    return render_template('admin/manage_prices.html', prices=prices)
+    return render_template('admin/manage_prices.html', prices=price_board.board())
 
 @main_bp.route('/admin/prices/add', methods=['GET', 'POST'])
 @login_required
@@ -525,6 +702,7 @@ def add_price():
 
             new_price = MarketPrice(name=name, category=category, price=price, unit=unit, location=location)
             db.session.add(new_price); db.session.commit()
+            price_board.invalidate()
             flash('Market price added successfully!', 'success')
             return redirect(url_for('main.admin_manage_prices'))
         except Exception as e:
@@ -532,6 +710,32 @@ def add_price():
             return render_template('admin/add_price.html', form_data=request.form)
     return render_template('admin/add_price.html', form_data={})
 
+@main_bp.route('/admin/prices/import', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def import_prices():
+    if request.method == 'POST':
+        file = request.files.get('price_file')
+        if not file or not file.filename:
+            flash('Choose a CSV or JSON file to import.', 'danger')
+            return redirect(request.url)
+        fmt = request.form.get('format') or detect_price_format(file.filename)
+        if fmt not in PRICE_IMPORT_FORMATS:
+            flash('Unsupported file format.', 'danger')
+            return redirect(request.url)
+        try:
+            summary = import_price_file(file.stream, fmt, batch_size=current_app.config.get('PRICE_IMPORT_BATCH_SIZE', 1000))
+        except Exception as e:
+            flash(f'Error importing market prices: {str(e)}', 'danger'); print(f"Import Prices Error: {e}")
+            return redirect(request.url)
+        price_board.invalidate()
+        for error in summary['errors']:
+            flash(error, 'warning')
+        flash(f"Imported {summary['rows']} rows ({summary['created']} new, {summary['updated']} updated, "
+              f"{summary['skipped']} skipped) in {summary['seconds']:.2f}s, {summary['rows_per_second']:.0f} rows/s.", 'success')
+        return redirect(url_for('main.admin_manage_prices'))
+    return render_template('admin/import_prices.html')
+
 @main_bp.route('/admin/prices/edit/<int:price_id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -542,8 +746,10 @@ def edit_price(price_id):
             # Add validation similar to add_price if needed
             historical_entry = MarketPriceHistory(market_price_id=price.id, price=price.price, date=price.updated_at)
             db.session.add(historical_entry)
+            record_price_history([(price.id, price.price, price.updated_at)])
             price.name = request.form.get('name','').strip(); price.category = request.form.get('category','').strip(); price.price = float(request.form.get('price',0)); price.unit = request.form.get('unit','').strip(); price.location = request.form.get('location','').strip() or None; price.updated_at = datetime.utcnow()
             db.session.commit()
+            price_board.invalidate()
             flash('Market price updated successfully!', 'success')
             return redirect(url_for('main.admin_manage_prices'))
         except Exception as e:
@@ -558,7 +764,9 @@ def delete_price(price_id):
     price = MarketPrice.query.get_or_404(price_id)
     try:
         MarketPriceHistory.query.filter_by(market_price_id=price.id).delete()
+        delete_price_rollups(price.id)
         db.session.delete(price); db.session.commit()
+        price_board.invalidate()
         flash('Market price deleted successfully!', 'success')
     except Exception as e:
         db.session.rollback(); flash(f'Error deleting market price: {str(e)}', 'danger'); print(f"Delete Price Error: {e}")
@@ -651,7 +859,7 @@ def edit_user(user_id):
             user.username = request.form['username']; user.email = request.form['email']; user.phone_number = request.form['phone_number']; user.role = new_role; user.age = int(request.form['age']) if request.form['age'] else None; user.gender = request.form['gender']; user.address = request.form['address']; user.farmer_type = request.form['farmer_type'] or None
             new_password = request.form.get('new_password')
             if new_password: user.set_password(new_password)
-            db.session.commit(); flash('User updated successfully!', 'success')
+            db.session.commit(); user_cache.invalidate(user.id); flash('User updated successfully!', 'success')
             return redirect(url_for('main.admin_users'))
         except Exception as e: db.session.rollback(); flash(f'Error updating user: {str(e)}', 'danger'); print(f"Edit User Error: {e}"); return render_template('admin/edit_user.html', user=user)
     return render_template('admin/edit_user.html', user=user)
@@ -662,7 +870,7 @@ def edit_user(user_id):
 def delete_user(user_id):
     if current_user.id == user_id: flash('Cannot delete your own admin account!', 'danger'); return redirect(url_for('main.admin_users'))
     user = User.query.get_or_404(user_id)
-    try: db.session.delete(user); db.session.commit(); flash('User deleted successfully!', 'success')
+    try: db.session.delete(user); db.session.commit(); user_cache.invalidate(user_id); flash('User deleted successfully!', 'success')
     except Exception as e: db.session.rollback(); flash(f'Error deleting user: {str(e)}', 'danger'); print(f"Delete User Error: {e}")
     return redirect(url_for('main.admin_users'))
 
@@ -690,8 +898,8 @@ def add_to_cart(listing_id):
             return redirect(request.referrer or url_for('main.browse_products'))
 
         # Check available quantity BEFORE checking if item is in cart
-        if quantity > product.quantity_available:
-            flash(f"Only {product.quantity_available} {product.unit} available.", "warning")
+        if quantity > product.available_quantity:
+            flash(f"Only {product.available_quantity} {product.unit} available.", "warning")
             # Redirect to referrer (likely product browse or detail page)
             return redirect(request.referrer or url_for('main.browse_products'))
 
@@ -720,27 +928,27 @@ def add_to_cart(listing_id):
 
 
     if cart_item:
-        # Update quantity
+        # Update quantity, holding the extra stock for this cart (renews the reservation)
         new_quantity = cart_item.quantity + quantity
-        if new_quantity > product.quantity_available:
-            flash(f"Cannot add {quantity} {product.unit}; only {product.quantity_available - cart_item.quantity:.1f} more available (you have {cart_item.quantity:.1f} in cart, total {product.quantity_available}).", "warning")
+        held = cart_item.reserved_quantity
+        if not reservations.reserve(cart_item, new_quantity):
+            db.session.rollback()
+            flash(f"Cannot add {quantity} {product.unit}; only {product.available_quantity:.1f} more available right now (you have {cart_item.quantity:.1f} in cart, {held:.1f} held for you).", "warning")
             # Don't proceed if exceeds available
             return redirect(request.referrer or url_for('main.browse_products'))
-        else:
-            cart_item.quantity = new_quantity
-            flash(f"Updated {product.name} quantity in cart.", "success")
+        cart_item.quantity = new_quantity
+        flash(f"Updated {product.name} quantity in cart.", "success")
     else:
-        # Add new item (we already checked quantity > product.quantity_available earlier)
-        # Check again just in case cart didn't exist before flush
-        if quantity > product.quantity_available:
-             flash(f"Cannot add {quantity} {product.unit}; only {product.quantity_available} available.", "warning")
-             return redirect(request.referrer or url_for('main.browse_products')) # Add redirect here
-
         # Ensure user_cart has an ID before creating CartItem
         if not user_cart.id:
              db.session.flush() # Assigns ID to user_cart if it's new
 
         cart_item = CartItem(cart_id=user_cart.id, product_id=product.id, quantity=quantity)
+        # Hold the stock for this cart; fails if other carts took it since the check above
+        if not reservations.reserve(cart_item, quantity):
+            db.session.rollback()
+            flash(f"Cannot add {quantity} {product.unit}; only {product.available_quantity} available right now.", "warning")
+            return redirect(request.referrer or url_for('main.browse_products'))
         db.session.add(cart_item)
         flash(f"Added {product.name} to cart.", "success")
 
@@ -769,7 +977,7 @@ def view_cart():
         cart_items = user_cart.items.options(
             db.joinedload(CartItem.product).joinedload(ProductListing.farmer)
         ).all()
-        cart_total = user_cart.total_price
+        cart_total = Cart.total_for_items(cart_items) # Reuses the loaded items, no extra query
 
     return render_template('cart/view_cart.html', cart_items=cart_items, cart_total=cart_total)
 
@@ -794,10 +1002,13 @@ def update_cart_item(item_id):
     try:
         quantity = float(quantity_str) 
         if quantity <= 0:
+            reservations.release(cart_item)
             db.session.delete(cart_item)
             flash("Item removed from cart.", "success")
-        elif quantity > cart_item.product.quantity_available:
-             flash(f"Cannot update: only {cart_item.product.quantity_available} {cart_item.product.unit} available.", "warning")
+        elif not reservations.reserve(cart_item, quantity):
+             db.session.rollback()
+             available = cart_item.product.available_quantity + cart_item.reserved_quantity
+             flash(f"Cannot update: only {available} {cart_item.product.unit} available right now.", "warning")
 
         else:
             cart_item.quantity = quantity
@@ -826,6 +1037,7 @@ def remove_cart_item(item_id):
         return redirect(url_for('main.view_cart'))
 
     try:
+        reservations.release(cart_item) # Give the held stock back to other shoppers
         db.session.delete(cart_item)
         db.session.commit()
         flash("Item removed from cart.", "success")
@@ -846,19 +1058,34 @@ def checkout():
         flash("Only buyers can proceed to checkout.", "warning")
         return redirect(url_for('main.browse_products'))
 
+    # A replayed submission (double click, client retry) returns the order it already placed,
+    # before any cart loading or stock checks. The key is generated per checkout page view.
+    idempotency_key = None
+    if request.method == 'POST':
+        idempotency_key = (request.headers.get('Idempotency-Key') or request.form.get('idempotency_key') or '').strip() or None
+        if idempotency_key and len(idempotency_key) > OrderIdempotencyKey.MAX_LENGTH:
+            # Truncating could make two different keys collide, so an oversized key is refused
+            abort(400, description=f"Idempotency key must be at most {OrderIdempotencyKey.MAX_LENGTH} characters.")
+        if idempotency_key:
+            existing_order_id = OrderIdempotencyKey.find_order_id(current_user.id, idempotency_key)
+            if existing_order_id:
+                flash('This order has already been placed.', 'info')
+                return redirect(url_for('main.order_confirmation', order_id=existing_order_id))
+
     # Get user's cart
     user_cart = Cart.query.filter_by(user_id=current_user.id).first()
 
+    # Eager load products for display and price calculation
+    cart_items = user_cart.items.options(db.joinedload(CartItem.product)).all() if user_cart else []
+
     # Check if cart exists and has items
-    if not user_cart or not user_cart.items.first():
+    if not cart_items:
         flash("Your cart is empty. Please add items before checking out.", "warning")
         # Redirect to product Browse or cart page
         return redirect(url_for('main.browse_products'))
 
-    # Eager load products for display and price calculation
-    cart_items = user_cart.items.options(db.joinedload(CartItem.product)).all()
-    # Ensure cart_total uses Decimal if your total_price property returns it
-    cart_total_decimal = decimal.Decimal(str(user_cart.total_price)) # Convert cart total safely to Decimal
+    # Total from the items loaded above (no second pass over the cart)
+    cart_total_decimal = decimal.Decimal(str(Cart.total_for_items(cart_items))) # Convert cart total safely to Decimal
 
     if request.method == 'POST':
         # --- Process the Checkout Form ---
@@ -882,20 +1109,49 @@ def checkout():
                                    cart_items=cart_items,
                                    cart_total=cart_total_decimal, # Pass Decimal total
                                    form_data=request.form, # Pass submitted data back
+                                   idempotency_key=idempotency_key or uuid.uuid4().hex, # Same attempt, same key
                                    user=current_user)
         # --- End Validation ---
 
         # --- Create Order (Transaction Block) ---
         try:
+            # 0. Claim the idempotency key first, so a concurrent duplicate waits here
+            # (on the unique index) instead of repeating the stock checks and inserts
+            claimed_key = None
+            if idempotency_key:
+                try:
+                    claimed_key = OrderIdempotencyKey.claim(current_user.id, idempotency_key)
+                except IntegrityError:
+                    db.session.rollback()
+                    existing_order_id = OrderIdempotencyKey.find_order_id(current_user.id, idempotency_key)
+                    if existing_order_id:
+                        flash('This order has already been placed.', 'info')
+                        return redirect(url_for('main.order_confirmation', order_id=existing_order_id))
+                    flash('This order is already being processed.', 'info')
+                    return redirect(url_for('main.order_history'))
+
             # 1. Final Stock Check (Critical)
+            # Lock the cart items first (same order as reserve and the sweeper), re-reading our
+            # holds in case the sweeper released them, then every product in one SELECT ... FOR UPDATE
+            user_cart.items.with_for_update().populate_existing().all()
+            quantities = {}
+            held = {}
             for item in cart_items:
-                # Refresh product data from DB within transaction
-                # Using with_for_update() can lock rows in some DBs (e.g., PostgreSQL)
-                # product = ProductListing.query.with_for_update().get(item.product_id)
-                product = ProductListing.query.get(item.product_id) # Simpler approach first
-                if not product or product.quantity_available < item.quantity:
+                if item.product_id is None:
+                    flash("An item in your cart is no longer available. Please update your cart.", "danger")
+                    db.session.rollback()
+                    return redirect(url_for('main.view_cart'))
+                quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+                held[item.product_id] = held.get(item.product_id, 0) + item.reserved_quantity
+            locked_products = ProductListing.lock_for_checkout(list(quantities))
+            for product_id, quantity in quantities.items():
+                product = locked_products.get(product_id)
+                # Stock held by other carts is off limits; our own holds count towards us
+                available = product.available_quantity + held[product_id] if product else 0
+                if not product or available < quantity:
                     # If stock is insufficient, rollback and redirect to cart with error
-                    flash(f"Insufficient stock for '{item.product.name}'. Available: {product.quantity_available if product else 0}. Please update your cart.", "danger")
+                    product_name = product.name if product else 'an item'
+                    flash(f"Insufficient stock for '{product_name}'. Available: {available}. Please update your cart.", "danger")
                     db.session.rollback()
                     return redirect(url_for('main.view_cart'))
 
@@ -919,39 +1175,35 @@ def checkout():
             )
             db.session.add(new_order)
             db.session.flush() # Assign ID to new_order for OrderItems
+            if claimed_key:
+                claimed_key.order_id = new_order.id # Committed together with the order
 
-            # 4. Create OrderItem Records and Decrease Stock
+            # 4. Create OrderItem Records (one batched INSERT) and Decrease Stock
+            order_item_rows = []
             for item in cart_items:
-                # Create OrderItem with snapshot data
-                order_item = OrderItem(
+                # Snapshot data from the locked, freshly loaded product
+                product = locked_products[item.product_id]
+                order_item_rows.append(dict(
                     order_id=new_order.id,
                     product_listing_id=item.product_id,
-                    product_name=item.product.name,
-                    product_unit=item.product.unit,
+                    product_name=product.name,
+                    product_unit=product.unit,
                     quantity=item.quantity,
                     # Convert product price to Decimal for storing in OrderItem
-                    price_per_unit=decimal.Decimal(str(item.product.price))
-                )
-                db.session.add(order_item)
-
-                # Decrease stock in ProductListing (fetch again for safety within transaction)
-                product = ProductListing.query.get(item.product_id)
-                if product: # Should always be found based on earlier check
-                    product.quantity_available -= item.quantity
-                    # Optional: Prevent negative stock
-                    if product.quantity_available < 0:
-                        product.quantity_available = 0
-                    # Optional: Update product status if stock runs out
-                    # if product.quantity_available == 0:
-                    #     product.status = 'sold_out'
-                else:
-                    # This case indicates a problem (product disappeared mid-transaction)
-                    raise Exception(f"Product ID {item.product_id} not found during stock update.")
+                    price_per_unit=decimal.Decimal(str(product.price))
+                ))
+            db.session.execute(db.insert(OrderItem), order_item_rows)
+
+            # Decrease stock (consuming our reservations) for all products in one guarded UPDATE
+            if not ProductListing.decrement_stock(quantities, held):
+                # Only reachable without row locks, when another order took the stock first
+                raise Exception("Stock changed while placing your order. Please review your cart.")
 
 
             # 5. Clear the Cart
-            # Delete cart items efficiently. Deleting the cart cascades.
-            db.session.delete(user_cart)
+            # Delete cart items with one statement, then the cart itself.
+            CartItem.query.filter_by(cart_id=user_cart.id).delete()
+            Cart.query.filter_by(id=user_cart.id).delete()
 
             # 6. Commit Transaction
             db.session.commit()
@@ -979,6 +1231,7 @@ def checkout():
                            cart_items=cart_items,
                            cart_total=cart_total_decimal, # Pass Decimal total
                            form_data=default_form_data, # Pass defaults for GET
+                           idempotency_key=uuid.uuid4().hex, # Identifies this checkout attempt
                            user=current_user)
 
 
@@ -1018,13 +1271,117 @@ def order_history():
 def inject_unread_message_count():
     """Injects the count of unread messages into all templates for the current user."""
     if current_user.is_authenticated:
-        unread_count = Message.query.filter_by(
-            recipient_id=current_user.id,
-            is_read=False
-        ).count()
-        return dict(unread_message_count_global=unread_count)
+        # Denormalized on the already-loaded user row, so rendering costs no extra query
+        return dict(unread_message_count_global=current_user.unread_message_count or 0)
     return dict(unread_message_count_global=0)
 
+@main_bp.app_context_processor
+def inject_image_url():
+    """Lets templates link the smallest suitable rendition: image_url(filename, 'thumb' | 'card')."""
+    return dict(image_url=image_url)
+
+@main_bp.app_context_processor
+def inject_vs_market():
+    """Lets catalog cards compare a listing with the official market price: vs_market(product)."""
+    return dict(vs_market=price_comparison.compare)
+
+def message_event(message):
+    """Serializes a message for real-time streams (call after flush, so id and timestamp are set)."""
+    return {
+        'id': message.id,
+        'conversation_id': message.conversation_id,
+        'sender_id': message.sender_id,
+        'recipient_id': message.recipient_id,
+        'content': message.content,
+        'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M')
+    }
+
+def publish_message_event(event):
+    """Pushes a committed message to its conversation stream and both participants' inbox streams."""
+    try:
+        broker.publish(conversation_channel(event['conversation_id']), event)
+        for user_id in {event['sender_id'], event['recipient_id']}:
+            if user_id:
+                broker.publish(user_channel(user_id), event)
+    except Exception as e:
+        # Delivery is best effort; clients catch up from the database when they reconnect
+        print(f"Error publishing message {event['id']}: {e}")
+
+def format_sse(data, event_id=None, event='message'):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+def streams_tie_up_worker():
+    """
+    True when an open response blocks its whole worker process, as with gunicorn's default
+    sync workers. Threaded servers and gevent/eventlet workers serve other requests meanwhile.
+    """
+    mode = current_app.config.get('SSE_STREAM_MODE', 'auto')
+    if mode != 'auto':
+        return mode == 'long-poll'
+    if request.environ.get('wsgi.multithread'):
+        return False
+    for module, patched in (('gevent.monkey', 'is_module_patched'), ('eventlet.patcher', 'is_monkey_patched')):
+        if module in sys.modules and getattr(sys.modules[module], patched)('socket'):
+            return False
+    return True
+
+def sse_response(subscription, backlog=()):
+    """
+    Streams broker events from `subscription` as Server-Sent Events, after replaying `backlog`.
+    The generator does not touch the database, so no connection is held while the stream is open.
+    On a server where the stream would block a whole worker, it becomes a long poll instead:
+    the response ends once it has sent the events available (everything already queued is
+    drained first) or after SSE_LONG_POLL_TIMEOUT seconds, and the browser reconnects with
+    Last-Event-ID, from which conversation and inbox streams replay what they missed.
+    """
+    heartbeat = current_app.config.get('SSE_HEARTBEAT_SECONDS', 15)
+    long_poll = streams_tie_up_worker()
+    if long_poll:
+        lifetime = current_app.config.get('SSE_LONG_POLL_TIMEOUT', 20)
+    else:
+        lifetime = current_app.config.get('SSE_STREAM_TIMEOUT', 300)
+
+    # Published between subscribing and reading the backlog: already sent, so skipped
+    replayed = {event['id'] for event in backlog}
+
+    def generate():
+        try:
+            yield f"retry: {500 if long_poll else 3000}\n\n"
+            for event in backlog:
+                yield format_sse(event, event_id=event['id'])
+            sent = bool(backlog)
+            deadline = time.monotonic() + lifetime
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if long_poll and sent:
+                    # Drain what is already queued, then end the poll; nothing is left behind
+                    # in the subscription that close() discards
+                    item = subscription.get(timeout=0)
+                    if item is None:
+                        break
+                else:
+                    item = subscription.get(timeout=min(heartbeat, remaining))
+                if item is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                _channel, event = item
+                if event.get('id') in replayed:
+                    continue
+                yield format_sse(event, event_id=event.get('id'))
+                sent = True
+        finally:
+            subscription.close()
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @main_bp.route('/messages/start/<int:listing_id>', methods=['POST'])
 @login_required
 def start_conversation(listing_id):
@@ -1079,11 +1436,14 @@ def start_conversation(listing_id):
         db.session.flush() # Get conversation.id
         first_message.conversation_id = conversation.id # Ensure it's set
         db.session.add(first_message)
+        conversation.register_message(first_message)
 
         conversation.updated_at = datetime.utcnow() # Update conversation timestamp
+        event = message_event(first_message)
 
         try:
             db.session.commit()
+            publish_message_event(event)
             flash(f"Conversation started with {farmer.username} regarding '{listing.name}'.", "success")
         except Exception as e:
             db.session.rollback()
@@ -1105,12 +1465,45 @@ def list_conversations():
     """
     Displays a list of all conversations (inbox) for the current user.
     """
-    # Fetch conversations where the current user is either the buyer or the farmer
-    conversations = Conversation.query.filter(
+    # Fetch conversations where the current user is either the buyer or the farmer.
+    # Unread counts and the last message are denormalized onto Conversation, and the
+    # related rows the inbox shows are joined in, so this is a single query.
+    conversations = Conversation.query.options(
+        db.joinedload(Conversation.last_message).load_only(Message.sender_id, Message.content),
+        db.joinedload(Conversation.product_listing).load_only(ProductListing.name),
+        db.joinedload(Conversation.buyer).load_only(User.username),
+        db.joinedload(Conversation.farmer).load_only(User.username)
+    ).filter(
         or_(Conversation.buyer_id == current_user.id, Conversation.farmer_id == current_user.id)
     ).order_by(Conversation.updated_at.desc()).all()
+    # The inbox stream replays anything newer than what the page shows
+    last_message_id = max((conversation.last_message_id or 0 for conversation in conversations), default=0) or None
 
-    return render_template('messages/conversation_list.html', conversations=conversations)
+    return render_template('messages/conversation_list.html', conversations=conversations,
+                           last_message_id=last_message_id)
+
+
+def fetch_message_window(conversation, before_id=None, page_size=None):
+    """
+    Returns (messages, has_older) with the newest `page_size` messages of a conversation,
+    optionally only those older than message `before_id`, in chronological order.
+    """
+    page_size = page_size or current_app.config.get('MESSAGES_PER_PAGE', 50)
+    query = Message.query.filter(Message.conversation_id == conversation.id)
+    if before_id:
+        before_timestamp = db.select(Message.timestamp).where(
+            Message.id == before_id, Message.conversation_id == conversation.id
+        ).scalar_subquery()
+        query = query.filter(db.or_(
+            Message.timestamp < before_timestamp,
+            db.and_(Message.timestamp == before_timestamp, Message.id < before_id)
+        ))
+    # Newest first with one extra row to know whether older messages remain
+    rows = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(page_size + 1).all()
+    has_older = len(rows) > page_size
+    messages = rows[:page_size]
+    messages.reverse()
+    return messages, has_older
 
 
 @main_bp.route('/messages/<int:conversation_id>', methods=['GET', 'POST'])
@@ -1127,13 +1520,19 @@ def view_conversation(conversation_id):
         return redirect(url_for('main.list_conversations'))
 
     if request.method == 'POST':
+        # The chat page posts with fetch and receives its own message back over the stream
+        wants_json = request.accept_mimetypes.best == 'application/json'
         content = request.form.get('content', '').strip()
         if not content:
+            if wants_json:
+                return jsonify({'error': 'Message content cannot be empty.'}), 400
             flash("Message content cannot be empty.", "warning")
         else:
             # Determine recipient
             recipient_user = conversation.get_other_user(current_user.id)
             if not recipient_user:
+                if wants_json:
+                    return jsonify({'error': 'Could not determine message recipient.'}), 400
                 flash("Could not determine message recipient.", "danger")
                 return redirect(url_for('main.view_conversation', conversation_id=conversation.id))
 
@@ -1144,60 +1543,174 @@ def view_conversation(conversation_id):
                 content=content
             )
             db.session.add(new_message)
+            conversation.register_message(new_message)
             conversation.updated_at = datetime.utcnow() # Update conversation timestamp
+            event = message_event(new_message)
 
             try:
                 db.session.commit()
+                publish_message_event(event)
                 # flash("Message sent!", "success") # Optional: Can be too noisy
+                if wants_json:
+                    return jsonify({'message': event}), 201
             except Exception as e:
                 db.session.rollback()
-                flash(f"Error sending message: {str(e)}", "danger")
                 print(f"Error sending message: {e}")
+                if wants_json:
+                    return jsonify({'error': f'Error sending message: {str(e)}'}), 500
+                flash(f"Error sending message: {str(e)}", "danger")
 
         # Redirect to the same page to show the new message (GET request)
         return redirect(url_for('main.view_conversation', conversation_id=conversation.id))
 
-    # GET request: Mark messages as read by the current user in this conversation
-    # This is a simplified approach. For unread counts, you'd compare message.recipient_id
-    messages_to_mark_read = Message.query.filter_by(
-        conversation_id=conversation.id,
-        recipient_id=current_user.id,
-        is_read=False
-    ).all()
-
-    for msg in messages_to_mark_read:
-        msg.is_read = True
-    if messages_to_mark_read:
+    # GET request: Mark messages as read by the current user in this conversation (one UPDATE)
+    if conversation.unread_count_for(current_user.id):
         try:
+            conversation.mark_read_by(current_user.id)
             db.session.commit()
         except Exception as e:
             db.session.rollback()
             print(f"Error marking messages as read: {e}")
 
 
-    # Fetch all messages for display, already ordered by timestamp in model relationship
-    messages = conversation.messages # Or .limit(50).all() for pagination later
+    # Only the most recent window of messages; older ones load on demand via conversation_older_messages
+    messages, has_older = fetch_message_window(conversation)
 
     other_user = conversation.get_other_user(current_user.id)
 
     return render_template('messages/conversation_detail.html',
                            conversation=conversation,
                            messages=messages,
+                           has_older=has_older,
                            other_user=other_user)
 
+
+@main_bp.route('/messages/<int:conversation_id>/stream', methods=['GET'])
+@login_required
+def conversation_stream(conversation_id):
+    """Server-Sent Events stream of new messages in a conversation."""
+    conversation = Conversation.query.get_or_404(conversation_id)
+    if current_user.id != conversation.buyer_id and current_user.id != conversation.farmer_id:
+        return jsonify({'error': 'You do not have permission to view this conversation.'}), 403
+
+    # Subscribe before reading the backlog so nothing published in between is lost
+    subscription = broker.subscribe([conversation_channel(conversation.id)])
+    backlog = []
+    # Browsers send Last-Event-ID on reconnect; the page passes last_id on first connect
+    last_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('last_id', type=int)
+    if last_id:
+        missed = Message.query.filter(Message.conversation_id == conversation.id, Message.id > last_id) \
+            .order_by(Message.id).limit(current_app.config.get('MESSAGES_PER_PAGE', 50)).all()
+        backlog = [message_event(message) for message in missed]
+    db.session.close()  # Release the connection before the long-lived response starts
+    return sse_response(subscription, backlog)
+
+
+@main_bp.route('/messages/stream', methods=['GET'])
+@login_required
+def inbox_stream():
+    """Server-Sent Events stream of new messages in any of the current user's conversations."""
+    subscription = broker.subscribe([user_channel(current_user.id)])
+    backlog = []
+    # As for conversation streams: Last-Event-ID on reconnect, last_id from the inbox page
+    last_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('last_id', type=int)
+    if last_id:
+        # The messages published to this user's channel: those they sent or received
+        missed = Message.query.filter(or_(Message.sender_id == current_user.id, Message.recipient_id == current_user.id),
+                                      Message.id > last_id) \
+            .order_by(Message.id).limit(current_app.config.get('MESSAGES_PER_PAGE', 50)).all()
+        backlog = [message_event(message) for message in missed]
+    db.session.close()
+    return sse_response(subscription, backlog)
+
+
+@main_bp.route('/messages/<int:conversation_id>/read', methods=['POST'])
+@login_required
+def mark_conversation_read(conversation_id):
+    """Marks the current user's unread messages in a conversation as read without re-rendering the thread."""
+    conversation = Conversation.query.get_or_404(conversation_id)
+    if current_user.id != conversation.buyer_id and current_user.id != conversation.farmer_id:
+        return jsonify({'error': 'You do not have permission to view this conversation.'}), 403
+
+    try:
+        marked_read = conversation.mark_read_by(current_user.id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error marking messages as read: {e}")
+        return jsonify({'error': 'Could not mark messages as read.'}), 500
+
+    return jsonify({
+        'marked_read': marked_read,
+        'unread_message_count': current_user.unread_message_count
+    })
+
+
+@main_bp.route('/messages/<int:conversation_id>/older', methods=['GET'])
+@login_required
+def conversation_older_messages(conversation_id):
+    """Returns the window of messages older than ?before=<message_id> as an HTML fragment."""
+    conversation = Conversation.query.get_or_404(conversation_id)
+    if current_user.id != conversation.buyer_id and current_user.id != conversation.farmer_id:
+        return jsonify({'error': 'You do not have permission to view this conversation.'}), 403
+
+    before_id = request.args.get('before', type=int)
+    if not before_id:
+        return jsonify({'error': 'The before parameter is required.'}), 400
+
+    messages, has_older = fetch_message_window(conversation, before_id=before_id)
+    html = render_template('messages/_message_list.html', messages=messages)
+    return jsonify({
+        'html': html,
+        'oldest_id': messages[0].id if messages else None,
+        'has_older': has_older
+    })
+
 # --- End Messaging Routes ---
 
 # --- API Routes ---
-# (get_price_history remains unchanged)
 @main_bp.route('/api/prices/history/<int:price_id>', methods=['GET'])
 @login_required
-def get_price_history(price_id): price_info = MarketPrice.query.get(price_id); history = MarketPriceHistory.query.filter_by(market_price_id=price_id).order_by(MarketPriceHistory.date.asc()).all(); response = [{'price': float(h.price), 'date': h.date.strftime('%Y-%m-%d %H:%M:%S')} for h in history]; current_price_data = {'price': float(price_info.price), 'date': price_info.updated_at.strftime('%Y-%m-%d %H:%M:%S')}; return jsonify({'history': response, 'current': current_price_data})
+def get_price_history(price_id):
+    """
+    Price history for charts, bounded in size. Query parameters:
+    from / to: 'YYYY-MM-DD' or ISO datetime range (to is inclusive for bare dates);
+    bucket: 'auto' (default: raw rows, LTTB-downsampled when too many), 'raw', 'lttb',
+    or 'day' / 'week' / 'month' for OHLC buckets (read from the rollup tables, whole periods);
+    points: maximum number of points returned.
+    """
+    price_info = db.session.get(MarketPrice, price_id)
+    if price_info is None:
+        return jsonify({'error': 'Market price not found.'}), 404
+
+    max_points = current_app.config.get('PRICE_HISTORY_MAX_POINTS', 1000)
+    bucket = request.args.get('bucket', 'auto')
+    try:
+        start = parse_range_bound(request.args.get('from'))
+        end = parse_range_bound(request.args.get('to'), end=True)
+        points = int(request.args.get('points', current_app.config.get('PRICE_HISTORY_DEFAULT_POINTS', 300)))
+    except ValueError:
+        return jsonify({'error': "Invalid 'from', 'to' or 'points' parameter."}), 400
+    if bucket not in PRICE_HISTORY_BUCKETS:
+        return jsonify({'error': f"Invalid 'bucket'; use one of: {', '.join(PRICE_HISTORY_BUCKETS)}."}), 400
+    points = min(max(points, 3), max_points)
+
+    history, bucket_used, downsampled = build_price_series(price_id, start, end, bucket, points)
+    current_price_data = {'price': float(price_info.price), 'date': price_info.updated_at.strftime('%Y-%m-%d %H:%M:%S')}
+    return jsonify({'history': history, 'current': current_price_data,
+                    'bucket': bucket_used, 'downsampled': downsampled,
+                    'from': request.args.get('from'), 'to': request.args.get('to')})
 # --- Error Handlers ---
 # (forbidden_error, not_found_error remain unchanged)
 @main_bp.app_errorhandler(403)
 def forbidden_error(error): flash('You do not have permission to access this page.', 'danger'); return redirect(url_for('main.index') if current_user.is_authenticated else url_for('main.login'))
+# File endpoints never need the logged-in user, so their misses get a bare 404 instead of a
+# page whose navbar would load it
+FILE_ENDPOINTS = {'static', 'main.uploaded_file', 'main.image_rendition'}
 @main_bp.app_errorhandler(404)
-def not_found_error(error): return render_template('errors/404.html'), 404
+def not_found_error(error):
+    if request.endpoint in FILE_ENDPOINTS: return error
+    return render_template('errors/404.html'), 404
 @main_bp.app_errorhandler(500)
 def internal_error(error):
     print(f"Internal Server Error encountered: {error}")
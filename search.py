@@ -0,0 +1,234 @@
+import bisect
+import math
+import re
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import event, func
+
+from extensions import db
+from models import ProductListing
+
+# Field weights used by both backends. PostgreSQL maps them onto tsvector
+# weight labels (A/B/C); the in-process index multiplies term frequency by them.
+FIELD_WEIGHTS = {'name': 3.0, 'category': 2.0, 'description': 1.0}
+PG_WEIGHT_LABELS = {'name': 'A', 'category': 'B', 'description': 'C'}
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+# Plurals formed with "-es" after these endings; any other "-es" is a word ending in "e" plus "s"
+ES_PLURAL_STEMS = ('s', 'x', 'z', 'ch', 'sh', 'o')
+STOP_WORDS = {'a', 'an', 'and', 'are', 'for', 'in', 'is', 'of', 'on', 'or', 'the', 'to', 'with'}
+
+
+def tokenize(text):
+    """
+    Lowercases and splits text into search tokens, dropping stop words and reducing plurals to
+    their singular, so "apples" and "apple" (or "tomatoes" and "tomato") give the same token.
+    """
+    tokens = []
+    for token in TOKEN_RE.findall((text or '').lower()):
+        if token in STOP_WORDS:
+            continue
+        if len(token) > 4 and token.endswith('ies'):
+            token = token[:-3] + 'y'    # berries -> berry
+        elif len(token) > 4 and token.endswith('es') and token[:-2].endswith(ES_PLURAL_STEMS):
+            token = token[:-2]          # tomatoes -> tomato, boxes -> box, radishes -> radish
+        elif len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]          # apples -> apple, grapes -> grape
+        tokens.append(token)
+    return tokens
+
+
+def build_search_vector(name, category, description):
+    """SQL expression for ProductListing.search_vector on PostgreSQL (weighted tsvector)."""
+    fields = {'name': name, 'category': category, 'description': description}
+    vector = None
+    for field, label in PG_WEIGHT_LABELS.items():
+        part = func.setweight(func.to_tsvector('english', func.coalesce(fields[field], '')), label)
+        vector = part if vector is None else vector.op('||')(part)
+    return vector
+
+
+@event.listens_for(ProductListing, 'before_insert')
+@event.listens_for(ProductListing, 'before_update')
+def _update_search_vector(mapper, connection, target):
+    """Keeps search_vector in step with the listing text on PostgreSQL."""
+    if connection.dialect.name == 'postgresql':
+        target.search_vector = build_search_vector(target.name, target.category, target.description)
+
+
+class ProductSearchIndex:
+    """
+    In-process inverted index over active product listings, used when the
+    database has no native full-text search (e.g. SQLite).
+
+    Lookups only touch the postings of the query tokens, plus a bisect over the
+    sorted vocabulary for prefix matches, so search cost grows with the number
+    of matches rather than the size of the catalog.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = defaultdict(dict)  # token -> {listing_id: weighted term frequency}
+        self._doc_tokens = {}               # listing_id -> set of tokens (for removal)
+        self._vocabulary = []               # sorted tokens, for prefix lookups
+        self._built_at = None
+
+    # --- Maintenance ---
+    def rebuild(self):
+        """Rebuilds the whole index from the active listings in the database."""
+        rows = db.session.query(ProductListing.id, ProductListing.name,
+                                ProductListing.category, ProductListing.description
+                                ).filter(ProductListing.status == 'active').all()
+        postings = defaultdict(dict)
+        doc_tokens = {}
+        for row in rows:
+            weights = self._weigh(row.name, row.category, row.description)
+            for token, weight in weights.items():
+                postings[token][row.id] = weight
+            doc_tokens[row.id] = set(weights)
+        with self._lock:
+            self._postings = postings
+            self._doc_tokens = doc_tokens
+            self._vocabulary = sorted(postings)
+            self._built_at = time.monotonic()
+
+    def refresh_listing(self, listing):
+        """Re-indexes a single listing after it was added or edited. Inactive listings are dropped."""
+        if self._built_at is None:
+            return  # Not built yet; the first search will load current data
+        with self._lock:
+            self._remove(listing.id)
+            if listing.status == 'active':
+                weights = self._weigh(listing.name, listing.category, listing.description)
+                for token, weight in weights.items():
+                    if token not in self._postings:
+                        bisect.insort(self._vocabulary, token)
+                    self._postings[token][listing.id] = weight
+                self._doc_tokens[listing.id] = set(weights)
+
+    def remove_listing(self, listing_id):
+        """Drops a deleted listing from the index."""
+        with self._lock:
+            self._remove(listing_id)
+
+    def clear(self):
+        with self._lock:
+            self._postings = defaultdict(dict)
+            self._doc_tokens = {}
+            self._vocabulary = []
+            self._built_at = None
+
+    # --- Querying ---
+    def search(self, text, limit=None):
+        """
+        Returns listing ids ranked by TF-IDF relevance (up to `limit`, or all of them). Every
+        token matches as a prefix, as in the PostgreSQL query.
+        """
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        self._ensure_fresh()
+        with self._lock:
+            doc_count = max(len(self._doc_tokens), 1)
+            scores = None
+            for token in tokens:
+                token_scores = {}
+                for term in self._prefix_terms(token):
+                    postings = self._postings.get(term)
+                    if not postings:
+                        continue
+                    idf = math.log(1 + doc_count / len(postings))
+                    for listing_id, weight in postings.items():
+                        token_scores[listing_id] = max(token_scores.get(listing_id, 0.0), weight * idf)
+                # Every query token must match (AND semantics, like to_tsquery with '&')
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {lid: score + token_scores[lid] for lid, score in scores.items() if lid in token_scores}
+                if not scores:
+                    return []
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return [listing_id for listing_id, _ in ranked[:limit]]
+
+    # --- Internals ---
+    def _ensure_fresh(self):
+        # Other worker processes keep their own copy, so rebuild periodically to pick up their writes
+        max_age = current_app.config.get('SEARCH_INDEX_MAX_AGE', 300)
+        if self._built_at is None or time.monotonic() - self._built_at > max_age:
+            self.rebuild()
+
+    def _prefix_terms(self, prefix):
+        index = bisect.bisect_left(self._vocabulary, prefix)
+        terms = []
+        while index < len(self._vocabulary) and self._vocabulary[index].startswith(prefix):
+            terms.append(self._vocabulary[index])
+            index += 1
+        return terms
+
+    def _remove(self, listing_id):
+        for token in self._doc_tokens.pop(listing_id, ()):
+            postings = self._postings.get(token)
+            if postings is None:
+                continue
+            postings.pop(listing_id, None)
+            if not postings:
+                del self._postings[token]
+                index = bisect.bisect_left(self._vocabulary, token)
+                if index < len(self._vocabulary) and self._vocabulary[index] == token:
+                    self._vocabulary.pop(index)
+
+    @staticmethod
+    def _weigh(name, category, description):
+        weights = defaultdict(float)
+        for field, text in (('name', name), ('category', category), ('description', description)):
+            for token in tokenize(text):
+                weights[token] += FIELD_WEIGHTS[field]
+        return weights
+
+
+search_index = ProductSearchIndex()
+
+
+def use_native_search():
+    """True when listings should be searched with PostgreSQL full-text search."""
+    backend = current_app.config.get('SEARCH_BACKEND', 'auto')
+    if backend == 'auto':
+        return db.engine.dialect.name == 'postgresql'
+    return backend == 'postgresql'
+
+
+def rank_listings(query, text, limit=None):
+    """
+    Returns ids of listings matched by `query` and the search text, most relevant first.
+    `query` is a ProductListing query that already carries the catalog filters.
+    """
+    limit = limit or current_app.config.get('SEARCH_MAX_RESULTS', 500)
+    tokens = tokenize(text)
+    if not tokens:
+        return []
+
+    if use_native_search():
+        # Prefix-match every token so results update while the user types
+        ts_query = func.to_tsquery('english', ' & '.join(f"{token}:*" for token in tokens))
+        rank = func.ts_rank(ProductListing.search_vector, ts_query)
+        rows = (query.with_entities(ProductListing.id)
+                .filter(ProductListing.search_vector.op('@@')(ts_query))
+                .order_by(rank.desc(), ProductListing.id.desc())
+                .limit(limit).all())
+        return [row.id for row in rows]
+
+    # Apply the remaining catalog filters (status, category) before the limit, a batch of
+    # candidates at a time until enough pass, so a narrow filter still finds its matches
+    candidate_ids = search_index.search(text)
+    results = []
+    for start in range(0, len(candidate_ids), limit):
+        batch = candidate_ids[start:start + limit]
+        allowed = {row.id for row in query.with_entities(ProductListing.id)
+                   .filter(ProductListing.id.in_(batch)).all()}
+        results.extend(listing_id for listing_id in batch if listing_id in allowed)
+        if len(results) >= limit:
+            break
+    return results[:limit]
@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from config import Config  # noqa: E402
+from extensions import db  # noqa: E402
+from models import User  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """An app on a throwaway SQLite file database, with the per-process caches emptied."""
+    monkeypatch.setattr(Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setattr(Config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(Config, 'RESERVATION_SWEEP_INTERVAL', 0)
+    app = create_app()
+    app.config['TESTING'] = True
+
+    import jobs
+    from cache import category_facets, price_board, upload_stats, user_cache
+    from price_comparison import price_comparison
+    from search import search_index
+    jobs._requested.clear()
+    search_index.clear()
+    price_comparison.clear()
+    user_cache.clear()  # A new app's version store starts over, so old entries would look current
+    category_facets.invalidate()
+    upload_stats.invalidate()
+
+    with app.app_context():
+        price_board.invalidate()
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def make_user(username, role='user', farmer_type=None, password='secret'):
+    user = User(username=username, email=f"{username}@example.com", role=role, farmer_type=farmer_type)
+    user.set_password(password)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def login(client, user, password='secret'):
+    return client.post('/login', data={'email': user.email, 'password': password})
@@ -0,0 +1,60 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from conftest import login, make_user
+from extensions import db
+from models import MarketPrice, ProductListing
+
+# Statements one catalog request may issue, however many cards the page has: the page of
+# listings with their farmers, the search candidates' filter, and the cart and unread
+# message lookups for a logged-in buyer. Facets, search index, market prices and the
+# user itself come from the per-process caches.
+MAX_QUERIES_PER_PAGE = 4
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+@pytest.fixture
+def catalog(app):
+    """Three pages of listings from several farmers, and a market price for the "vs market" badges."""
+    farmers = [make_user(f"farmer{i}", farmer_type='crop') for i in range(5)]
+    for i in range(app.config['PRODUCTS_PER_PAGE'] * 3):
+        db.session.add(ProductListing(name=f"Rice {i}", category='Grain' if i % 2 else 'Vegetable',
+                                      price=40 + i, unit='kg', quantity_available=10, status='active',
+                                      user_id=farmers[i % len(farmers)].id))
+    db.session.add(MarketPrice(name='Rice', category='Grain', price=45, unit='kg'))
+    db.session.commit()
+
+
+@pytest.mark.parametrize('logged_in', [False, True])
+@pytest.mark.parametrize('params', [{}, {'search': 'rice'}, {'category': 'Grain'}])
+def test_catalog_pages_use_a_fixed_number_of_queries(app, client, catalog, params, logged_in):
+    if logged_in:
+        login(client, make_user('buyer'))
+    client.get('/products', query_string=params)  # Warm the per-process caches
+
+    with count_queries() as statements:
+        response = client.get('/products', query_string=params)
+    assert response.status_code == 200
+    assert len(statements) <= MAX_QUERIES_PER_PAGE, statements
+
+    cursor = response.get_data(as_text=True).split('data-next-cursor="', 1)[1].split('"', 1)[0]
+    with count_queries() as statements:
+        response = client.get('/products/page', query_string=dict(params, cursor=cursor))
+    assert response.status_code == 200
+    assert response.get_json()['html'].count('product-card"') > 0
+    assert len(statements) <= MAX_QUERIES_PER_PAGE, statements
@@ -0,0 +1,44 @@
+import pytest
+
+from conftest import login, make_user
+from extensions import db
+from models import Cart, CartItem, Order, OrderIdempotencyKey, ProductListing
+
+CHECKOUT_FORM = {'recipient_name': 'Buyer', 'recipient_phone': '09170000000',
+                 'shipping_address': 'Market St.', 'payment_method': 'cod'}
+
+
+@pytest.fixture
+def buyer(app, client):
+    farmer = make_user('farmer', farmer_type='crop')
+    listing = ProductListing(name='Mangoes', category='Fruit', price=120, unit='kg', quantity_available=5,
+                             status='active', user_id=farmer.id)
+    buyer = make_user('buyer')
+    cart = Cart(user_id=buyer.id)
+    db.session.add_all([listing, cart])
+    db.session.flush()
+    db.session.add(CartItem(cart_id=cart.id, product_id=listing.id, quantity=1))
+    db.session.commit()
+    login(client, buyer)
+    return buyer
+
+
+@pytest.mark.parametrize('use_header', [False, True])
+def test_checkout_rejects_oversized_idempotency_keys(client, buyer, use_header):
+    key = 'k' * (OrderIdempotencyKey.MAX_LENGTH + 1)
+    if use_header:
+        response = client.post('/checkout', data=CHECKOUT_FORM, headers={'Idempotency-Key': key})
+    else:
+        response = client.post('/checkout', data=dict(CHECKOUT_FORM, idempotency_key=key))
+    assert response.status_code == 400
+    assert Order.query.count() == 0
+    assert OrderIdempotencyKey.query.count() == 0
+
+
+def test_checkout_replays_a_full_length_idempotency_key(client, buyer):
+    form = dict(CHECKOUT_FORM, idempotency_key='k' * OrderIdempotencyKey.MAX_LENGTH)
+    first = client.post('/checkout', data=form)
+    second = client.post('/checkout', data=form)
+    assert first.status_code == second.status_code == 302
+    assert first.headers['Location'] == second.headers['Location']
+    assert Order.query.count() == 1
@@ -0,0 +1,75 @@
+import threading
+
+from conftest import make_user
+from extensions import db
+from models import Cart, CartItem, Order, ProductListing
+
+BUYERS = 8
+STOCK = 3
+HELD = 2  # Buyers whose cart still holds a reservation; the rest were swept
+
+CHECKOUT_FORM = {'recipient_name': 'Buyer', 'recipient_phone': '09170000000',
+                 'shipping_address': 'Market St.', 'payment_method': 'cod'}
+
+
+def test_concurrent_checkouts_never_oversell(app):
+    farmer = make_user('farmer', farmer_type='crop')
+    listing = ProductListing(name='Mangoes', category='Fruit', price=120, unit='kg', quantity_available=STOCK,
+                             quantity_reserved=HELD, status='active', user_id=farmer.id)
+    db.session.add(listing)
+    db.session.flush()
+    listing_id = listing.id
+    buyers = []
+    for i in range(BUYERS):
+        buyer = make_user(f"buyer{i}")
+        cart = Cart(user_id=buyer.id)
+        db.session.add(cart)
+        db.session.flush()
+        db.session.add(CartItem(cart_id=cart.id, product_id=listing_id, quantity=1,
+                                reserved_quantity=1 if i < HELD else 0))
+        buyers.append(buyer)
+    db.session.commit()
+    emails = [buyer.email for buyer in buyers]
+    holders = {buyer.id for buyer in buyers[:HELD]}
+
+    # Sample the listing from its own connection while the checkouts race
+    samples = []
+    done = threading.Event()
+    engine = db.engine
+
+    def sample():
+        with engine.connect() as connection:
+            while not done.is_set():
+                samples.append(connection.execute(
+                    db.select(ProductListing.quantity_available, ProductListing.quantity_reserved)
+                    .where(ProductListing.id == listing_id)).one())
+
+    start = threading.Barrier(BUYERS)
+    statuses = []
+
+    def checkout(email):
+        # Each thread runs its requests in its own app context, so it logs in there
+        client = app.test_client()
+        client.post('/login', data={'email': email, 'password': 'secret'})
+        start.wait()
+        statuses.append(client.post('/checkout', data=CHECKOUT_FORM).status_code)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    threads = [threading.Thread(target=checkout, args=(email,)) for email in emails]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    sampler.join()
+
+    assert statuses == [302] * BUYERS
+    db.session.expire_all()
+    assert Order.query.count() == STOCK
+    # Held stock can't be taken by the swept carts, so both holders got their order
+    assert {order.user_id for order in Order.query} >= holders
+    listing = db.session.get(ProductListing, listing_id)
+    assert (listing.quantity_available, listing.quantity_reserved) == (0, 0)
+    assert samples
+    assert all(available >= 0 and reserved >= 0 for available, reserved in samples), samples
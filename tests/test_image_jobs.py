@@ -0,0 +1,100 @@
+import os
+
+import pytest
+from PIL import Image
+
+import jobs
+from conftest import make_user
+from extensions import db
+from images import renditions_exist
+from jobs import queue_renditions, run_worker
+from models import ImageJob, ProductListing
+
+FILENAME = 'abc123.jpg'
+RENDITION_URL = f'/uploads/renditions/card/{FILENAME}'
+
+
+@pytest.fixture
+def stored_image(app, monkeypatch):
+    """An uploaded JPEG without renditions yet, with 'background' processing."""
+    monkeypatch.setitem(app.config, 'IMAGE_PROCESSING', 'background')
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    Image.new('RGB', (1200, 900), (90, 160, 60)).save(os.path.join(app.config['UPLOAD_FOLDER'], FILENAME), 'JPEG')
+    return FILENAME
+
+
+def add_job(status, attempts):
+    job = ImageJob(filename=FILENAME, status=status, attempts=attempts, error='boom' if status == 'failed' else None)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def test_rendition_request_queues_an_image_without_a_job(client, stored_image):
+    response = client.get(RENDITION_URL)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'  # The original until the worker has run
+    assert ImageJob.query.filter_by(filename=FILENAME, status='pending').count() == 1
+
+
+def test_rendition_request_leaves_failed_jobs_alone(client, stored_image):
+    job = add_job('failed', 3)
+
+    assert client.get(RENDITION_URL).status_code == 200
+    db.session.refresh(job)
+    assert (job.status, job.attempts, job.error) == ('failed', 3, 'boom')
+
+
+def test_rendition_request_requeues_done_jobs_with_missing_files(client, stored_image):
+    job = add_job('done', 1)
+
+    client.get(RENDITION_URL)
+    db.session.refresh(job)
+    assert (job.status, job.attempts) == ('pending', 0)
+
+
+def test_rendition_requests_check_the_job_once_per_ttl(client, stored_image):
+    client.get(RENDITION_URL)
+    ImageJob.query.delete()
+    db.session.commit()
+
+    client.get(RENDITION_URL)
+    assert ImageJob.query.count() == 0
+
+
+def test_new_upload_retries_a_failed_job(app, stored_image):
+    job = add_job('failed', 3)
+
+    assert queue_renditions(FILENAME) is False
+    db.session.commit()
+    db.session.refresh(job)
+    assert (job.status, job.attempts, job.error) == ('pending', 0, None)
+
+
+def test_worker_renders_queued_uploads(app, client, stored_image):
+    farmer = make_user('farmer', farmer_type='crop')
+    listing = ProductListing(name='Okra', category='Vegetable', price=60, unit='kg', quantity_available=5,
+                             status='active', user_id=farmer.id, image_filename=FILENAME,
+                             image_ready=queue_renditions(FILENAME))
+    db.session.add(listing)
+    db.session.commit()
+    assert listing.image_ready is False
+    assert ImageJob.query.filter_by(filename=FILENAME, status='pending').count() == 1
+
+    assert run_worker(processes=1, once=True) == 1
+    assert renditions_exist(FILENAME)
+    db.session.expire_all()
+    assert ImageJob.query.filter_by(filename=FILENAME).one().status == 'done'
+    assert db.session.get(ProductListing, listing.id).image_ready is True
+    assert client.get(RENDITION_URL).mimetype == 'image/webp'
+
+
+def test_missing_pillow_is_logged_once(app, stored_image, monkeypatch, caplog):
+    monkeypatch.setattr(jobs, 'Image', None)
+    monkeypatch.setattr(jobs, '_warned_missing_pillow', False)
+
+    assert queue_renditions(FILENAME) is True
+    assert queue_renditions('other.jpg') is True
+    warnings = [record for record in caplog.records if 'Pillow is not installed' in record.getMessage()]
+    assert len(warnings) == 1
+    assert ImageJob.query.count() == 0
@@ -0,0 +1,63 @@
+import io
+import os
+import time
+
+import pytest
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from images import discard_image, image_url, store_image
+
+CONTENT = b'not really a jpeg'
+
+
+def upload():
+    return FileStorage(stream=io.BytesIO(CONTENT), filename='photo.JPEG')
+
+
+def stored_path(app, filename):
+    return os.path.join(app.config['UPLOAD_FOLDER'], filename)
+
+
+def test_store_image_restores_a_discarded_file(app):
+    filename = store_image(upload())
+    os.remove(stored_path(app, filename))  # e.g. discard_image from another request
+
+    assert store_image(upload()) == filename
+    with open(stored_path(app, filename), 'rb') as stored:
+        assert stored.read() == CONTENT
+
+
+def test_discard_image_keeps_a_freshly_stored_file(app):
+    filename = store_image(upload())
+
+    discard_image(filename)
+    assert os.path.exists(stored_path(app, filename))
+
+    stale = time.time() - app.config['IMAGE_DISCARD_GRACE'] - 1
+    os.utime(stored_path(app, filename), (stale, stale))
+    discard_image(filename)
+    assert not os.path.exists(stored_path(app, filename))
+
+
+def jpeg_upload(size=(1600, 1200)):
+    data = io.BytesIO()
+    Image.new('RGB', size, (200, 120, 40)).save(data, 'JPEG')
+    data.seek(0)
+    return FileStorage(stream=data, filename='field.jpg')
+
+
+@pytest.mark.parametrize('rendition', ['card', 'thumb'])
+def test_rendition_route_serves_a_resized_webp(app, client, monkeypatch, rendition):
+    monkeypatch.setitem(app.config, 'IMAGE_PROCESSING', 'inline')
+    filename = store_image(jpeg_upload())
+
+    with app.test_request_context():
+        url = image_url(filename, rendition)  # What a catalog card links to
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/webp'
+    with Image.open(io.BytesIO(response.get_data())) as served:
+        assert served.format == 'WEBP'
+        assert max(served.size) == app.config['IMAGE_RENDITIONS'][rendition]
+    assert len(response.get_data()) < os.path.getsize(stored_path(app, filename))
@@ -0,0 +1,91 @@
+import time
+
+import pytest
+
+from broker import user_channel
+from conftest import login, make_user
+from extensions import broker, db
+from models import Conversation, Message
+from routes import streams_tie_up_worker
+
+
+@pytest.fixture
+def conversation(app):
+    buyer = make_user('buyer')
+    farmer = make_user('farmer', farmer_type='crop')
+    conversation = Conversation(buyer_id=buyer.id, farmer_id=farmer.id)
+    db.session.add(conversation)
+    db.session.commit()
+    return buyer, farmer, conversation
+
+
+@pytest.mark.parametrize('multithread, expected', [
+    (False, True),   # e.g. gunicorn sync workers
+    (True, False),
+])
+def test_auto_mode_long_polls_only_on_sync_servers(app, multithread, expected):
+    with app.test_request_context(multithread=multithread):
+        assert streams_tie_up_worker() is expected
+
+
+def test_long_poll_ends_after_replaying_missed_messages(app, client, conversation):
+    buyer, farmer, conversation = conversation
+    app.config['SSE_STREAM_MODE'] = 'long-poll'
+    messages = [Message(conversation_id=conversation.id, sender_id=farmer.id, recipient_id=buyer.id, content=text)
+                for text in ('First', 'Second')]
+    db.session.add_all(messages)
+    db.session.commit()
+    login(client, buyer)
+
+    started = time.monotonic()
+    body = client.get(f'/messages/{conversation.id}/stream', query_string={'last_id': messages[0].id}).get_data(as_text=True)
+    assert time.monotonic() - started < 1
+    assert 'Second' in body and 'First' not in body
+
+
+def test_idle_long_poll_ends_after_its_timeout(app, client, conversation):
+    buyer, _, conversation = conversation
+    app.config.update(SSE_STREAM_MODE='long-poll', SSE_LONG_POLL_TIMEOUT=1)
+    login(client, buyer)
+
+    started = time.monotonic()
+    body = client.get(f'/messages/{conversation.id}/stream').get_data(as_text=True)
+    assert time.monotonic() - started < 3
+    assert body.startswith('retry:')
+
+
+def test_inbox_long_poll_replays_messages_from_every_conversation(app, client, conversation):
+    buyer, farmer, conversation = conversation
+    other_farmer = make_user('other', farmer_type='livestock')
+    other = Conversation(buyer_id=buyer.id, farmer_id=other_farmer.id)
+    db.session.add(other)
+    db.session.flush()
+    seen = Message(conversation_id=conversation.id, sender_id=farmer.id, recipient_id=buyer.id, content='Seen')
+    db.session.add(seen)
+    db.session.flush()
+    db.session.add_all([
+        Message(conversation_id=other.id, sender_id=other_farmer.id, recipient_id=buyer.id, content='Missed one'),
+        Message(conversation_id=conversation.id, sender_id=buyer.id, recipient_id=farmer.id, content='Missed two'),
+    ])
+    db.session.commit()
+    app.config['SSE_STREAM_MODE'] = 'long-poll'
+    login(client, buyer)
+
+    started = time.monotonic()
+    body = client.get('/messages/stream', headers={'Last-Event-ID': str(seen.id)}).get_data(as_text=True)
+    assert time.monotonic() - started < 1
+    assert 'Missed one' in body and 'Missed two' in body and 'Seen' not in body
+
+
+def test_long_poll_drains_queued_events_before_ending(app, client, conversation):
+    buyer, farmer, conversation = conversation
+    app.config['SSE_STREAM_MODE'] = 'long-poll'
+    login(client, buyer)
+    event = {'conversation_id': conversation.id, 'sender_id': farmer.id, 'recipient_id': buyer.id, 'timestamp': ''}
+    channel = user_channel(buyer.id)
+
+    response = client.get('/messages/stream', buffered=False)  # Subscribed; the body isn't read yet
+    for number in (1, 2, 3):
+        broker.publish(channel, dict(event, id=number, content=f"Queued {number}"))
+    body = response.get_data(as_text=True)
+    assert all(f"Queued {number}" in body for number in (1, 2, 3))
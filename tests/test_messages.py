@@ -0,0 +1,39 @@
+from conftest import login, make_user
+from extensions import db
+from models import Conversation, Message
+
+CONTENT = '<script>alert("hi")</script>\nsecond line'
+ESCAPED = '&lt;script&gt;alert(&#34;hi&#34;)&lt;/script&gt;<br />second line'
+
+
+def make_conversation():
+    buyer = make_user('buyer')
+    farmer = make_user('farmer', farmer_type='crop')
+    conversation = Conversation(buyer_id=buyer.id, farmer_id=farmer.id)
+    db.session.add(conversation)
+    db.session.flush()
+    db.session.add(Message(conversation_id=conversation.id, sender_id=farmer.id, recipient_id=buyer.id, content=CONTENT))
+    db.session.flush()
+    latest = Message(conversation_id=conversation.id, sender_id=buyer.id, recipient_id=farmer.id, content='Thanks')
+    db.session.add(latest)
+    db.session.commit()
+    return buyer, conversation, latest
+
+
+def test_conversation_page_escapes_message_content(app, client):
+    buyer, conversation, _ = make_conversation()
+    login(client, buyer)
+
+    html = client.get(f'/messages/{conversation.id}').get_data(as_text=True)
+    assert ESCAPED in html
+    assert '<script>alert' not in html
+
+
+def test_older_messages_fragment_escapes_message_content(app, client):
+    buyer, conversation, latest = make_conversation()
+    login(client, buyer)
+
+    response = client.get(f'/messages/{conversation.id}/older', query_string={'before': latest.id})
+    html = response.get_json()['html']
+    assert ESCAPED in html
+    assert '<script>' not in html
@@ -0,0 +1,58 @@
+import pytest
+
+from conftest import make_user
+from extensions import db
+from models import MarketPrice, ProductListing
+from price_comparison import price_comparison
+
+
+@pytest.fixture
+def farmer(app):
+    return make_user('farmer', farmer_type='crop')
+
+
+def add_listing(farmer, name, price, unit='kg', category='Fruit'):
+    listing = ProductListing(name=name, category=category, price=price, unit=unit, quantity_available=10,
+                             status='active', user_id=farmer.id)
+    db.session.add(listing)
+    return listing
+
+
+@pytest.mark.parametrize('listing_name, market_name', [
+    ('Oranges', 'Orange'),
+    ('Fresh Apples', 'Apple'),
+    ('Ripe Tomatoes', 'Tomato'),
+    ('Apple', 'Apples'),
+])
+def test_plural_listing_names_match_market_prices(app, farmer, listing_name, market_name):
+    listing = add_listing(farmer, listing_name, 110)
+    db.session.add(MarketPrice(name=market_name, category='Fruit', price=100, unit='kg'))
+    db.session.commit()
+
+    with app.test_request_context():
+        comparison = price_comparison.compare(listing)
+    assert comparison is not None
+    assert comparison.name == market_name
+    assert comparison.percent == pytest.approx(10)
+
+
+def test_catalog_cards_show_market_comparison_for_plural_names(app, client, farmer):
+    add_listing(farmer, 'Oranges', 90)
+    db.session.add(MarketPrice(name='Orange', category='Fruit', price=100, unit='kilo'))
+    db.session.commit()
+
+    html = client.get('/products').get_data(as_text=True)
+    assert '10% below market' in html
+
+
+def test_rebuild_only_resets_listing_matches(app, farmer):
+    listing = add_listing(farmer, 'Oranges', 100)
+    db.session.add(MarketPrice(name='Orange', category='Fruit', price=100, unit='kg'))
+    db.session.commit()
+    with app.test_request_context():
+        assert price_comparison.compare(listing) is not None
+
+    price_comparison.rebuild()
+    assert price_comparison._listings == {}
+    with app.test_request_context():
+        assert price_comparison.compare(listing).name == 'Orange'
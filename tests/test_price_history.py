@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import login, make_user
+from extensions import db
+from models import MarketPrice, MarketPriceHistory
+from price_history import parse_range_bound
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2026-03-01T08:00:00+08:00', datetime(2026, 3, 1, 0, 0)),
+    ('2026-03-01T00:00:00Z', datetime(2026, 3, 1, 0, 0)),
+    ('2026-03-01T00:00:00', datetime(2026, 3, 1, 0, 0)),
+    ('2026-03-01', datetime(2026, 3, 1, 0, 0)),
+])
+def test_range_bounds_are_naive_utc(value, expected):
+    parsed = parse_range_bound(value)
+    assert parsed == expected
+    assert parsed.tzinfo is None
+
+
+def test_bare_end_date_includes_the_whole_day():
+    assert parse_range_bound('2026-03-01', end=True) == datetime(2026, 3, 2)
+
+
+def test_history_api_accepts_timezone_aware_ranges(app, client):
+    price = MarketPrice(name='Rice', category='Grain', price=50, unit='kg', updated_at=datetime(2026, 3, 5))
+    db.session.add(price)
+    db.session.flush()
+    for hour, value in [(0, 40), (6, 42), (12, 44)]:
+        db.session.add(MarketPriceHistory(market_price_id=price.id, price=value, date=datetime(2026, 3, 1, hour)))
+    db.session.commit()
+    login(client, make_user('buyer'))
+
+    # 05:00-13:00 in Manila (UTC+8) is 21:00 the day before to 05:00 UTC
+    response = client.get(f'/api/prices/history/{price.id}', query_string={
+        'from': '2026-03-01T05:00:00+08:00', 'to': '2026-03-01T13:00:00+08:00', 'bucket': 'raw'})
+    assert response.status_code == 200
+    assert [point['price'] for point in response.get_json()['history']] == [40]
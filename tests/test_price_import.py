@@ -0,0 +1,45 @@
+import io
+import json
+
+from conftest import login, make_user
+from extensions import db
+from models import MarketPrice, MarketPriceHistory
+from price_import import import_file
+
+
+def feed_lines(*records):
+    return '\n'.join(record if isinstance(record, str) else json.dumps(record) for record in records) + '\n'
+
+
+RICE = {'name': 'Rice', 'category': 'Grain', 'unit': 'kg', 'price': 50, 'date': '2026-03-01'}
+
+
+def test_malformed_json_lines_are_skipped_with_their_line_number(app):
+    feed = feed_lines(RICE, '{"name": "Corn", price: 30}', dict(RICE, price=52, date='2026-03-02'))
+
+    summary = import_file(io.StringIO(feed), 'json')
+    assert (summary['rows'], summary['skipped']) == (2, 1)
+    assert len(summary['errors']) == 1 and summary['errors'][0].startswith('Row 2: invalid JSON')
+    assert MarketPrice.query.one().price == 52
+
+
+def test_admin_import_reports_malformed_lines(app, client):
+    login(client, make_user('admin', role='admin'))
+    feed = feed_lines(RICE, '{not json')
+
+    response = client.post('/admin/prices/import', data={'price_file': (io.BytesIO(feed.encode()), 'feed.jsonl')},
+                           follow_redirects=True)
+    html = response.get_data(as_text=True)
+    assert 'Row 2: invalid JSON' in html
+    assert '1 new' in html and '1 skipped' in html
+    assert MarketPrice.query.count() == 1
+
+
+def test_prices_created_and_changed_by_one_feed_count_as_updated(app):
+    days = [dict(RICE, price=50 + day, date=f"2026-03-{day:02d}") for day in range(1, 29)]
+    days += [dict(RICE, name='Corn', price=30 + day, date=f"2026-03-{day:02d}") for day in range(1, 29)]
+
+    summary = import_file(io.StringIO(feed_lines(*days)), 'json')
+    assert (summary['created'], summary['updated']) == (2, 2)
+    assert MarketPriceHistory.query.count() == 54
+    assert db.session.query(MarketPrice.price).filter_by(name='Rice').scalar() == 78
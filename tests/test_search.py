@@ -0,0 +1,55 @@
+import pytest
+
+from conftest import make_user
+from extensions import db
+from models import ProductListing
+from search import rank_listings, tokenize
+
+
+@pytest.mark.parametrize('singular, plural', [
+    ('apple', 'apples'), ('orange', 'oranges'), ('grape', 'grapes'), ('tomato', 'tomatoes'),
+    ('mango', 'mangoes'), ('box', 'boxes'), ('radish', 'radishes'), ('peach', 'peaches'),
+    ('berry', 'berries'), ('egg', 'eggs'), ('glass', 'glasses'),
+])
+def test_singular_and_plural_give_the_same_token(singular, plural):
+    assert tokenize(singular) == tokenize(plural)
+
+
+def test_catalog_search_matches_plural_names(app, client):
+    farmer = make_user('farmer', farmer_type='crop')
+    for name in ('Apples', 'Oranges', 'Red Grapes', 'Potatoes'):
+        db.session.add(ProductListing(name=name, category='Fruit', price=10, unit='kg',
+                                      quantity_available=5, status='active', user_id=farmer.id))
+    db.session.commit()
+
+    for query, expected in (('apple', 'Apples'), ('orange', 'Oranges'),
+                            ('grape', 'Red Grapes'), ('potato', 'Potatoes')):
+        html = client.get('/products', query_string={'search': query}).get_data(as_text=True)
+        assert expected in html
+
+
+def add_listings(*listings):
+    farmer = make_user('farmer', farmer_type='crop')
+    for name, category, description in listings:
+        db.session.add(ProductListing(name=name, category=category, description=description, price=10, unit='kg',
+                                      quantity_available=5, status='active', user_id=farmer.id))
+    db.session.commit()
+
+
+def test_every_search_token_matches_as_a_prefix(app):
+    add_listings(('Fuji Apples', 'Fruit', None), ('Green Apples', 'Fruit', None))
+
+    with app.test_request_context():
+        ids = rank_listings(ProductListing.query, 'app fuj')
+    assert [db.session.get(ProductListing, listing_id).name for listing_id in ids] == ['Fuji Apples']
+
+
+def test_catalog_filters_apply_before_the_result_limit(app, monkeypatch):
+    # Name matches in another category outrank the Grain listings that only mention rice
+    add_listings(*[(f"Rice Cakes {i}", 'Snacks', None) for i in range(5)],
+                 ('Corn', 'Grain', 'Goes well with rice'), ('Barley', 'Grain', 'A rice substitute'))
+    monkeypatch.setitem(app.config, 'SEARCH_MAX_RESULTS', 3)
+
+    with app.test_request_context():
+        ids = rank_listings(ProductListing.query.filter_by(category='Grain'), 'rice')
+    assert sorted(db.session.get(ProductListing, listing_id).name for listing_id in ids) == ['Barley', 'Corn']